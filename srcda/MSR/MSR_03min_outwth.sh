@@ -38,7 +38,7 @@ export IFORTLIB="/share/pkg/intel/parallel_studio_xe_2018_u3ce/lib:/share/pkg/in
 export DYLD_LIBRARY_PATH="${IFORTLIB}:${DYLD_LIBRARY_PATH}"
 
 #*** 0c. OpenMP thread number
-export OMP_NUM_THREADS=20                          # OpenMP cpu num
+export OMP_NUM_THREADS=${OMP_NUM_THREADS:-20}     # OpenMP cpu num; set per member by assim_cama.py
 
 #================================================
 # (1) Experiment setting
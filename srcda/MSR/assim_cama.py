@@ -6,11 +6,23 @@ import xarray as xr
 import pytz
 import subprocess
 import os
+import glob
+import time
+import tempfile
 from distutils.util import strtobool
-from multiprocessing import Pool
 import pyletkf
 import caseExtention as ext
 import dautils as dau
+import enspool
+import obsstore
+import assimcalendar
+import threadbudget
+import checkpoint
+import outstore
+import ensstats
+import mapcache
+import inflation
+import profiler
 
 camaout_dtype = np.float32  # change if changed
 
@@ -108,10 +120,61 @@ class AssimCama(object):
         self.assimconfig = varDict["assimconfig"]
         self.undef = int(varDict["undef"])
         self.dummyfile = varDict["dummyfile"]
+        # "memory" to assemble state vectors in RAM (float64, reused),
+        # "disk" to use the dummyfile memmap for runs too large for RAM.
+        self.statebuffer = str(varDict.get("statebuffer", "memory"))
+        if self.statebuffer not in ["memory", "disk"]:
+            raise KeyError("undefined statebuffer: {0}"
+                           .format(self.statebuffer))
+        self._statevector = None
+        # True to load only the last output record of prognostic
+        # variables; valid since filtering() does not use the smoother.
+        self.laststep = bool(strtobool(varDict.get("laststep", "False")))
+        # seed for random number generators; None for os entropy.
+        self.seed = varDict.get("seed", None)
+        # True to load a member's outputs as soon as its run finishes.
+        self.pipeline = bool(strtobool(varDict.get("pipeline", "True")))
+        # minimum gap between assimilation cycles in days; 0 to keep all.
+        self.mingap = float(varDict.get("mingap", 0))
+        # observations within this window (days) are assimilated at once
+        # at the end of the window; 0 for one cycle per observation date.
+        self.cyclewindow = float(varDict.get("cyclewindow", 0))
+
+        # split cores between concurrent members (at most nCPUs) and
+        # OpenMP threads of each member; "ompthreads" defaults to
+        # ncores//nCPUs. "autotune" searches the split from wall times.
+        cores = threadbudget.available_cores()
+        ncores = int(varDict.get("ncores", len(cores)))
+        ompthreads = varDict.get("ompthreads", None)
+        if ompthreads is not None:
+            ompthreads = int(ompthreads)
+        autotune = bool(strtobool(varDict.get("autotune", "False")))
+        self.budget = threadbudget.ThreadBudget(cores[0:ncores], self.eTot,
+                                                self.nCPUs,
+                                                nthreads=ompthreads,
+                                                autotune=autotune)
+
+        # checkpoint ring of restart.bin and param/*.bin of every member,
+        # written in background every "checkpointevery" cycles.
+        self.ckptdir = varDict.get("checkpointdir",
+                                   os.path.join(self.modeldir, "out",
+                                                self.expname, "checkpoint"))
+        self.ckptkeep = int(varDict.get("checkpointkeep", 2))
+        self.ckptevery = int(varDict.get("checkpointevery", 1))
+        # river cells of each cycle's outputs are appended to one
+        # compressed HDF5 file. "" to keep renamed binaries instead.
+        self.outvars = ["outflw", "outwth", "flddph"]
+        self.outstorepath = varDict.get("outstore",
+                                        os.path.join(self.modeldir, "out",
+                                                     self.expname,
+                                                     "outputs.h5"))
+        # per-cycle ensemble mean, spread and innovations.
+        # "" not to keep statistics.
+        self.statspath = varDict.get("statsstore",
+                                     os.path.join(self.modeldir, "out",
+                                                  self.expname,
+                                                  "ensstats.h5"))
 
-        # read observations
-        self.obs_dset = self.read_observation(self.obsncpath)
-        self.assimdates = self.get_assimdates(self.obs_dset)
         vecmappath = str(varDict["vecmappath"])  # map_width.ipynb
         if os.path.exists(vecmappath):
             with h5py.File(vecmappath, "r") as f:
@@ -119,11 +182,80 @@ class AssimCama(object):
                 self.vec2lat = f["vec2lat"][:]
                 self.vec2lon = f["vec2lon"][:]
                 self.nvec = len(self.vec2lat)
+            # flat index for fused gather/scatter in camavec
+            self.vec2flat = dau.make_flatIndex(self.vec2lat, self.vec2lon,
+                                               self.nlon)
         else:
             raise IOError("{0} does not exist. You may create this from "
                           "dautils.make_vectorized2dIndex, but make sure "
                           "to match with your observation data label.")
 
+        # worker pool, checkpoint ring and HDF5 stores; closed by close().
+        try:
+            self.open()
+            self.setup(varDict, initialize=initialize,
+                       use_cached_lp=use_cached_lp)
+        except BaseException:
+            # do not leak workers and the checkpoint writer
+            self.close(raise_errors=False)
+            raise
+
+    def setup(self, varDict, initialize=True, use_cached_lp=False):
+        """
+        second half of register(), after open(): observations, map
+        cache, inflation, profiler and pyletkf.
+
+        Args:
+            varDict (dict): config
+            initialize (bool): True to perturb initial parameters
+            use_cached_lp (bool): True to use cached local patches
+        """
+        # read observations
+        self.obs_dset = self.read_observation(self.obsncpath)
+        self.assimdates = self.get_assimdates(self.obs_dset)
+        # vectorized static maps shared by workers as read-only .npy
+        self.mapcachedir = varDict.get("mapcache",
+                                       os.path.join(self.modeldir, "out",
+                                                    self.expname, "mapcache"))
+        # together with vectorization index; workers get only its path.
+        mapcache.build(self.mapcachedir, self.mapdir, self.nlat, self.nlon,
+                       self.map2vec, self.vec2lat, self.vec2lon, self.nlfp)
+        # analysis array is published to workers as a memmapped .npy
+        # in this directory (tmpfs if available).
+        sharedir = varDict.get("sharedir", "/dev/shm"
+                               if os.path.isdir("/dev/shm")
+                               else tempfile.gettempdir())
+        self.xapath = os.path.join(sharedir,
+                                   "{0}_{1}_xa.npy".format(self.expname,
+                                                           os.getpid()))
+
+        # parse observations once; no xarray selection in each cycle.
+        # the dataset is read "obschunk" dates at a time.
+        self.obsstore = obsstore.ObservationStore(
+                                self.obs_dset, self.obsnames, self.obsdist,
+                                self.nvec, self.undef,
+                                chunk=int(varDict.get("obschunk", 365)))
+        # observations are all in obsstore; do not keep the file open,
+        # as workers forked by open() after close() would inherit it.
+        self.obs_dset.close()
+
+        # index in statevars of each observation
+        self.obsidx = [idx for idx, flag in enumerate(self.obsvars)
+                       if flag == 1]
+
+        # inflation of the analysis and noise on parameters, drawn in
+        # this process from a generator keyed on seed.
+        self.inflation = self.get_inflation(varDict)
+        self.xppath = self.xapath.replace("_xa.npy", "_xp.npy")
+
+        # wall/cpu time, i/o and peak RSS of each phase of each cycle
+        # are appended to a JSON-lines log. "" not to keep the log.
+        profilepath = varDict.get("profile",
+                                  os.path.join(self.modeldir, "out",
+                                               self.expname, "profile.jsonl"))
+        self.timer = profiler.PhaseTimer(profilepath if profilepath != ""
+                                         else None)
+
         # instanciate pyletkf;
         # if local patch is not cached, it will be generated.
         self.dacore = pyletkf.LETKF_core(self.assimconfig,
@@ -151,49 +283,245 @@ class AssimCama(object):
         utc = pytz.utc
         sdate = utc.localize(sdate)
         edate = utc.localize(edate)
-        if spinup:
-            sedate = datetime.datetime(sdate.year+1, 1, 1)
-            sedate = utc.localize(sedate)
-            self.spinup(sdate, sedate, ensrnof=self.ensrnof)
         date = sdate
         nT = 0
-        while date < edate:
-            date, nT = self.driver(date, self.obs_dset)
-
-    def restart(self, edate):
-        # read most rescent backup info
-        with open(os.path.join(self.outdir.format(0), "ntlog.txt"), "r") as f:
-            rescent_info = f.readlines()[-1].split(",")
-        date = datetime.datetime.strptime(rescent_info[0], "%Y%m%d%H")
-        nT = int(rescent_info[1])
-        # copy backup restart files
-        resfile = "restart_{0}.bin".format(date.strftime("%Y%m%d%H"))
+        # spinup also runs on the pool, which must be shut down on failure
+        try:
+            if self.closed:
+                # after start() or restart() of this instance
+                self.open()
+            if spinup:
+                sedate = datetime.datetime(sdate.year+1, 1, 1)
+                sedate = utc.localize(sedate)
+                self.spinup(sdate, sedate, ensrnof=self.ensrnof)
+                self.flush_profile("spinup")
+            while date < edate:
+                date, nT = self.driver(date, self.obsstore)
+        except BaseException:
+            # errors in close() must not mask the original exception
+            self.close(raise_errors=False)
+            raise
+        self.close()
+
+    def restart(self, edate, sdate=None):
+        """
+        restart experiment from the newest complete checkpoint,
+        or from the spinup restart files if there is no checkpoint yet.
+
+        Args:
+            edate (datetime.datetime): end date
+            sdate (datetime.datetime): start date of the experiment, used
+                                       only without checkpoints. None to
+                                       use the date of the spinup backup.
+        """
+        edate = pytz.utc.localize(edate)
+        try:
+            if self.closed:
+                # after start() or restart() of this instance
+                self.open()
+            if self.checkpoints.latest() is not None:
+                # copy checkpointed restart and parameter files back
+                date, nT = self.checkpoints.restore()
+            else:
+                date, nT = self.restore_spinup(
+                        None if sdate is None else pytz.utc.localize(sdate))
+            print("restarting from {0}.".format(date.strftime("%Y%m%d%H")))
+            if self.outstore is not None:
+                # drop outputs written after the checkpoint
+                self.outstore.truncate(date)
+            if self.statsstore is not None:
+                self.statsstore.truncate(date)
+            while date < edate:
+                date, nT = self.driver(date, self.obsstore)
+        except BaseException:
+            self.close(raise_errors=False)
+            raise
+        self.close()
+
+    def restore_spinup(self, sdate=None):
+        """
+        copy the newest spinup restart files (see backup_restart()) and
+        initial parameters in init/ back to member output directories.
+
+        Args:
+            sdate (datetime.datetime): utc aware date to resume from.
+                                       None to use the date of the backup.
+
+        Returns:
+            datetime.datetime: utc aware next initial date
+            int: number of time steps of the last cycle (0)
+        """
+        resdir = os.path.join(self.outdir.format(0), "restart")
+        paths = sorted(glob.glob(os.path.join(resdir, "restart_*.bin")))
+        if len(paths) == 0:
+            raise IOError("no checkpoint in {0} nor spinup restart in {1}"
+                          .format(self.checkpoints.ckptdir, resdir))
+        resfile = os.path.basename(paths[-1])
         for eNum in range(self.eTot):
             outdir = self.outdir.format(eNum)
-            respath = os.path.join(outdir, "restart", resfile)
-            outpath = os.path.join(outdir, "restart.bin")
-            subprocess.check_call("cp", respath, outpath)
-        # restart simulation
-        while date < edate:
-            date, nT = self.driver(date, nT)
-
-    def driver(self, date, obs_dset):
-        test0 = np.fromfile(os.path.join(self.outdir.format(1), "param/rivhgt.bin"), np.float32).reshape(self.nlat, self.nlon)
-        test1 = np.fromfile(os.path.join(self.outdir.format(2), "param/rivhgt.bin"), np.float32).reshape(self.nlat, self.nlon)
-        print("max", test0.max(), test1.max())
-        print((test0 - test1).sum(), (test0 - test1).max(), (test0 - test1).min())
-        ndate, nT = self.forward(date,
-                                 ensrnof=self.ensrnof, restart=True)
-        adate = ndate - datetime.timedelta(seconds=86400)
-        self.filtering(adate, nT, obs_dset)
-        # if ndate.year > date.year:
-        #     self.backup_restart(ndate)
-        #     with open(os.path.join(self.outdir, "ntlog.txt"), "a") as f:
-        #         f.write("{0}, {1}"
-        #                 .format(ndate.strftime("%Y%m%d%H"), nT))
+            dau.stage_file(os.path.join(outdir, "restart", resfile),
+                           os.path.join(outdir, "restart.bin"))
+            for path in glob.glob(os.path.join(outdir, "init", "*.bin")):
+                dau.stage_file(path, os.path.join(outdir, "param",
+                                                  os.path.basename(path)))
+        if sdate is None:
+            sdate = datetime.datetime.strptime(resfile[len("restart_"):-4],
+                                               "%Y%m%d%H")
+            sdate = pytz.utc.localize(sdate)
+        return sdate, 0
+
+    def driver(self, date, obs):
+        with self.timer.phase("cycle"):
+            ndate, nT, statevector = self.forward(date,
+                                                  ensrnof=self.ensrnof,
+                                                  restart=True,
+                                                  pipeline=self.pipeline)
+            adate = ndate - datetime.timedelta(seconds=86400)
+            # all observation dates in this cycle; one date if cyclewindow=0
+            obsdates = self.assimdates.window(date, adate)
+            self.filtering(adate, nT, obs, statevector=statevector,
+                           obsdates=obsdates)
+            if self.outstore is not None:
+                with self.timer.phase("archive_outputs"):
+                    self.archive_outputs(date, nT)
+            with self.timer.phase("checkpoint"):
+                self.checkpoints.cycle(ndate, nT)
+        self.flush_profile(date)
         return ndate, nT
 
     # utilities
+    def open(self):
+        """
+        create the worker pool, the checkpoint ring and the HDF5 stores.
+        called by register(), and by start()/restart() after close() so
+        that one instance can run again.
+
+        Notes:
+            the long-lived worker pool is reused by every phase of every
+            cycle. It is created first, before the checkpoint writer
+            thread starts and before any dataset is opened, so that
+            workers do not inherit threads or open file handles; it is
+            forked once with enough workers for every split, as autotune
+            only resizes it.
+        """
+        self.pool = enspool.EnsemblePool(self.budget.nprocs, self.eTot,
+                                         cpusets=self.budget.cpusets(),
+                                         nthreads=self.budget.nthreads,
+                                         nworkers=self.budget.poolsize())
+        self.closed = False
+        self.checkpoints = checkpoint.CheckpointRing(self.ckptdir,
+                                                     self.outdir, self.eTot,
+                                                     keep=self.ckptkeep,
+                                                     every=self.ckptevery)
+        if self.outstorepath == "":
+            self.outstore = None
+        else:
+            self.outstore = outstore.OutputStore(self.outstorepath,
+                                                 self.outvars,
+                                                 self.eTot, self.nvec,
+                                                 dtype=camaout_dtype)
+        if self.statspath == "":
+            self.statsstore = None
+        else:
+            self.statsstore = ensstats.StatsStore(self.statspath,
+                                                  len(self.statevars),
+                                                  len(self.obsnames),
+                                                  self.nvec, self.undef)
+
+    def close(self, raise_errors=True):
+        """
+        shut down the worker pool created by open(),
+        and flush checkpoints.
+
+        Args:
+            raise_errors (bool): False to only print errors of the pool
+                                 or the checkpoint writer, e.g., while
+                                 another exception is propagating.
+        """
+        error = None
+        for name in ["pool", "checkpoints"]:
+            if not hasattr(self, name):
+                continue
+            try:
+                getattr(self, name).close()
+            except Exception as e:
+                if error is None:
+                    error = e
+        if getattr(self, "outstore", None) is not None:
+            self.outstore.close()
+        if getattr(self, "statsstore", None) is not None:
+            self.statsstore.close()
+        for path in [getattr(self, "xapath", None),
+                     getattr(self, "xppath", None)]:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+        self.closed = True
+        if error is not None:
+            if raise_errors:
+                raise error
+            print("error on close: {0}".format(error))
+
+    def get_inflation(self, varDict):
+        """
+        instanciate inflation.Inflation from config.
+
+        Args:
+            varDict (dict): config
+
+        Returns:
+            inflation.Inflation
+
+        Notes:
+            "inflationvars" and "noisevars" default to every
+            parameter in statevars. Factors given as a list, or units
+            of "class", use width classes of rivwth (see
+            caseExtention.get_width_class).
+        """
+        params = [var for idx, var in enumerate(self.statevars)
+                  if self.statetype[idx] == "parameter"]
+        method = str(varDict.get("inflation", "none"))
+        factor = varDict.get("inflationfactor", 1)
+        unit = str(varDict.get("inflationunit", "vecid"))
+        noisestd = varDict.get("noisestd", 0.25)
+        noiseunit = str(varDict.get("noiseunit", "member"))
+        classid = None
+        if "class" in [unit, noiseunit] or np.ndim(factor) > 0 \
+           or np.ndim(noisestd) > 0:
+            rivwth = mapcache.load(self.mapcachedir)["rivwth"]
+            classid = ext.get_width_class(rivwth, ext.get_width_medians())
+        varidx = [self.statevars.index(var)
+                  for var in varDict.get("inflationvars", params)]
+        noiseidx = [self.statevars.index(var)
+                    for var in varDict.get("noisevars", params)]
+        return inflation.Inflation(method, factor, varidx, self.statedist,
+                                   seed=self.seed, unit=unit,
+                                   noisestd=noisestd, noiseidx=noiseidx,
+                                   noiseunit=noiseunit, classid=classid)
+
+    def flush_profile(self, cycle):
+        """
+        gather phase records of workers and of this process, and
+        append those to the profile log.
+
+        Args:
+            cycle (datetime.datetime or str): date or label of the cycle
+        """
+        for records in self.pool.map(profiler.collect,
+                                     [[] for eNum in range(self.eTot)]):
+            self.timer.extend(records)
+        # phases of module-level functions run in this process
+        self.timer.extend(profiler.timer.drain())
+        self.timer.flush(cycle)
+
+    def resize_pool(self):
+        """
+        apply the current split of self.budget (e.g., after autotuning)
+        to the running workers. Workers are not re-forked, as stores are
+        open and the checkpoint writer is running by then.
+        """
+        self.pool.resize(self.budget.nprocs, cpusets=self.budget.cpusets(),
+                         nthreads=self.budget.nthreads)
+
     def check_consistency(self):
         """
         checking data shapes to avoid mistakenly use data from
@@ -215,7 +543,7 @@ class AssimCama(object):
         Args:
             date (datetime.datetime): current date (simulation starts from)
                                       must be utc aware object
-            assimdates (list): datetime.datetime objects, in utc posix form
+            assimdates (assimcalendar.AssimCalendar): assimilation dates
 
         Returns:
             tuple: [start, end], datetime.datetime objects
@@ -227,10 +555,7 @@ class AssimCama(object):
         assert date.tzinfo is not None\
             and date.tzinfo.utcoffset(date) is not None,\
             "date is not utc aware"
-        # This is O(n), and binary search will be O(logn)
-        # However, here len(assimdates) won't be that big,
-        # and making for;if;else loop would be more costfull.
-        nextAssimDate = [dd for dd in assimdates if date < dd][0]
+        nextAssimDate = assimdates.next_date(date)
         return [date, nextAssimDate]
 
     def read_observation(self, ncpath):
@@ -255,15 +580,11 @@ class AssimCama(object):
             obsdset (xr.Dataset): observation dataset
 
         Returns:
-            list
+            assimcalendar.AssimCalendar
         """
-        utc = pytz.utc
-        dates = obsdset["time"].values
-        # dates.tolist() converts np.datetime64 to posix timestamp
-        dtdates = [datetime.datetime.utcfromtimestamp(date/1e9) for date in
-                   dates.tolist()]
-        dates = [utc.localize(dtdate) for dtdate in dtdates]
-        return dates
+        return assimcalendar.AssimCalendar.from_dataset(
+                                        obsdset, mingap=self.mingap,
+                                        cyclewindow=self.cyclewindow)
 
     def initialize(self):
         """
@@ -274,14 +595,16 @@ class AssimCama(object):
 
         Notes:
             To tweak behavior of a perturbation, edit caseExtention.py
+            Initial ensembles are reproducible if seed is set in config.
         """
+        rng = np.random.default_rng(self.seed)
         for idx, var in enumerate(self.statevars):
             if self.statetype[idx] == "prognostic":
                 continue
             elif self.statetype[idx] == "parameter":
                 ext.gain_perturbation(var, self.outdir, self.mapdir,
                                       self.nlat, self.nlon,
-                                      self.eTot)
+                                      self.eTot, self.vec2flat, rng=rng)
             else:
                 raise IndexError("type %s is " +
                                  "not defined".format(self.statetype[idx]))
@@ -305,14 +628,12 @@ class AssimCama(object):
                                             simrange[0].strftime("%Y%m%d%H"),
                                             simrange[1].strftime("%Y%m%d%H"))
               )
-        p = Pool(self.nCPUs)
         argslist = [
                     [self.camagosh, self.modeldir, self.expname, self.rnofdir,
-                     simrange, eNum, ensrnof, False]
+                     simrange, eNum, ensrnof, False, self.budget.nthreads]
                     for eNum in range(0, self.eTot)
                     ]
-        p.map(run_CaMa_, argslist)
-        p.close()
+        self.pool.map(run_CaMa_, argslist)
         # backup spiup files
         self.backup_restart(edate + datetime.timedelta(seconds=86400))
 
@@ -326,10 +647,10 @@ class AssimCama(object):
             datestring = date.strftime("%Y%m%d%H")
             bpath = os.path.join(resdir,
                                 "restart_{0}.bin".format(datestring))
-            subprocess.check_call(["cp", respath, bpath])
+            dau.stage_file(respath, bpath)
 
     # forwarding functions
-    def forward(self, date, ensrnof=False, restart=True):
+    def forward(self, date, ensrnof=False, restart=True, pipeline=False):
         """
         fowwarding a state until next observation is available.
 
@@ -340,48 +661,111 @@ class AssimCama(object):
             restart (bool): True if restart from previous time restart file
                         This is usualy True, only pass False when you
                         want to start from zero storage for some reason.
+            pipeline (bool): True to read and vectorize each member's
+                        outputs as soon as its run finishes, overlapping
+                        I/O with the members still running.
 
         Returns:
             datetime.datetime: next initial date
+            int: number of time steps forwarded
+            np.ndarray-like: state vector [nvars, eTot, nT, nvec] if
+                             pipeline is True, else None.
         """
         simrange = self.get_nextSimDates(date, self.assimdates)
         print("forwarding state from {0} to {1}.".format(
                                             simrange[0].strftime("%Y%m%d%H"),
                                             simrange[1].strftime("%Y%m%d%H"))
               )
-        p = Pool(self.nCPUs)
+        ndate = simrange[1] + datetime.timedelta(seconds=86400)
+        nT = (ndate-date).days
         argslist = [
                     [self.camagosh, self.modeldir, self.expname, self.rnofdir,
-                     simrange, eNum, ensrnof, restart]
+                     simrange, eNum, ensrnof, restart, self.budget.nthreads]
                     for eNum in range(0, self.eTot)
                     ]
-        p.map(run_CaMa_, argslist)
-        p.close()
-        ndate = simrange[1] + datetime.timedelta(seconds=86400)
-        nT = (ndate-date).days
-        print(date, ndate, nT)  # check carefully
-        return ndate, nT
+        if pipeline:
+            statevector = self.alloc_statevector(nT)
+            walltimes = []
+            # members are yielded in the order they finish.
+            for eNum, wtime in self.pool.imap_unordered(run_CaMa_, argslist):
+                with self.timer.phase("load_statevector", member=eNum):
+                    self.load_statevector(statevector, eNum, nT)
+                walltimes.append(wtime)
+        else:
+            walltimes = self.pool.map(run_CaMa_, argslist)
+            statevector = None
+        if self.budget.record(nT, walltimes):
+            print("members x threads: {0} x {1}"
+                  .format(self.budget.nprocs, self.budget.nthreads))
+            self.resize_pool()
+        return ndate, nT, statevector
     #
 
     # filtering functions
-    def filtering(self, date, nT, obs):
+    def filtering(self, date, nT, obs, statevector=None, obsdates=None):
         """
         LETKF at assmilation date
 
         Args:
             date (datetime.datetime): current date
             nT (int): number of time steps in output time
+            obs (obsstore.ObservationStore): observation store
+            statevector (np.ndarray-like): state vector already loaded
+                                           (e.g., in pipelined forward).
+                                           None to read it from files.
+            obsdates (np.ndarray): observation dates binned into this
+                                   cycle. None to use date only.
         """
-        statevector = self.const_statevector(nT)
-        obs, obserr = self.const_obs(obs, date)
+        if statevector is None:
+            with self.timer.phase("const_statevector"):
+                statevector = self.const_statevector(nT)
+        if obsdates is None:
+            obsdates = [date]
+        with self.timer.phase("const_obs"):
+            obs, obserr = self.const_obs(obs, obsdates)
 
-        # pyletkf assumes double precision
-        statevector = statevector.astype(np.float64)
-        obs = obs.astype(np.float64)
-        obserr = obs.astype(np.float64)
-        xa, _ = self.dacore.letkf_vector(statevector, obs, obserr, self.obsvars,
-                                         nCPUs=self.nCPUs, smoother=False)
-        self.update_states(xa, nT, date)
+        # pyletkf assumes double precision;
+        # no copy if the buffer is already assembled in float64.
+        statevector = statevector.astype(np.float64, copy=False)
+        obs = obs.astype(np.float64, copy=False)
+        obserr = obserr.astype(np.float64, copy=False)
+        # smoother must be False if laststep is True;
+        # the state vector only has the last time step.
+        if self.statsstore is not None or self.inflation.needs_prior:
+            with self.timer.phase("ensstats"):
+                fstats = ensstats.EnsembleStats.from_ensemble(
+                                                statevector[:, :, -1, :])
+        with self.timer.phase("letkf_vector"):
+            xa, _ = self.dacore.letkf_vector(statevector, obs, obserr,
+                                             self.obsvars, nCPUs=self.nCPUs,
+                                             smoother=False)
+        # analysis diagnostics describe the filter output,
+        # thus are taken before inflation modifies xa in place.
+        if self.statsstore is not None:
+            with self.timer.phase("ensstats"):
+                astats = ensstats.EnsembleStats.from_ensemble(xa[:, :, -1, :])
+        # inflate the last step in place, and draw parameter noise
+        # here so that workers do no random work.
+        with self.timer.phase("inflation"):
+            rng = self.inflation.apply(date, xa[:, :, -1, :],
+                                       fspread=fstats.spread()
+                                       if self.inflation.needs_prior
+                                       else None)
+            xp = self.inflation.perturb(date, xa[:, :, -1, :], rng=rng)
+        if self.statsstore is not None:
+            with self.timer.phase("ensstats"):
+                self.statsstore.append(
+                    date,
+                    forecast_mean=fstats.mean(),
+                    forecast_spread=fstats.spread(),
+                    analysis_mean=astats.mean(),
+                    analysis_spread=astats.spread(),
+                    omf=ensstats.innovation(obs, fstats.mean(), self.obsidx,
+                                            self.undef),
+                    oma=ensstats.innovation(obs, astats.mean(), self.obsidx,
+                                            self.undef))
+        with self.timer.phase("update_states"):
+            self.update_states(xa, nT, date, xp=xp)
 
     def const_statevector(self, nT):
         """
@@ -393,80 +777,114 @@ class AssimCama(object):
             (REC in Fortran) in your file.
 
         Returns:
-            np.ndarray-like: memory mapped array like object
+            np.ndarray-like: see alloc_statevector()
         """
-        # create buffer array, this is used for concatenating memmap objects.
-        buffer = np.memmap(self.dummyfile, dtype=np.float32, mode="w+",
-                           shape=(len(self.statevars), self.eTot,
-                                  nT, self.nvec)
-                           )
-        for idx, var in enumerate(self.statevars):  # not that many
-            for eNum in range(self.eTot):  # not that many
-                if self.statetype[idx] == "prognostic":
-                    d = dau.load_data3d(os.path.join(self.outdir.format(eNum),
-                                                     "{0}.bin".format(var)
-                                                     ),
-                                         nT, self.nlat, self.nlon,
-                                         self.map2vec, self.nvec, dtype=np.float32
-                                         )
-                else:  # parameter
-                    d = dau.load_data3d(os.path.join(self.outdir.format(eNum),
-                                                     "param/",
-                                                     "{0}.bin".format(var)
-                                                     ),
-                                         1, self.nlat, self.nlon,
-                                         self.map2vec, self.nvec, dtype=np.float32
-                                         )
-                if self.statedist[idx] == "log":
-                    d[d==0] = 1e-8  # replace zero
-                    buffer[idx, eNum, :, :] = np.log(d)
-                elif self.statedist[idx] == "norm":
-                    buffer[idx, eNum, :, :] = d
-                else:
-                    raise KeyError("undefined distribution: {0}".format(self.statedist[idx]))
+        buffer = self.alloc_statevector(nT)
+        for eNum in range(self.eTot):  # not that many
+            self.load_statevector(buffer, eNum, nT)
         return buffer
 
-    def const_obs(self, obsdset, date):
+    def alloc_statevector(self, nT):
         """
-        parse observation xarray and returns data at the date
+        allocate a state vector buffer [nvars, eTot, nT, nvec].
 
         Args:
-            obs (xarray.Dataset): observation dataset object
-            date (datetime.datetime): date
-        """
-        obs_values_all = []
-        obs_errors_all = []
-        for idx, obsname in enumerate(self.obsnames):
-            vecids = obsdset[obsname].vecid.values
-            obs = obsdset[obsname].sel(time=date,
-                                   kind="values").values
-            obsall = np.ones([self.nvec], np.float64)*self.undef
-            err = obsdset[obsname].sel(time=date,
-                                   kind="errors").values
-            errall = np.ones([self.nvec], np.float64)*self.undef
-            if self.obsdist[idx] == "log":
-                undefloc = (obs == self.undef)
-                obs[undefloc] = 1.  # temporaly assign positive value incalse undef is negative.
-                err[undefloc] = 1.
-                logobs = np.log(obs)
-                logerr = np.log(err)
-                logobs[undefloc] = self.undef
-                logerr[undefloc] = self.undef
-                obsall[vecids] = logobs
-                errall[vecids] = logerr
-            elif self.obsdist[idx] == "norm":
-                obsall[vecids] = obs
-                errall[vecids] = err
+            nT (int): number of time steps passed
+
+        Returns:
+            np.ndarray-like: float64 in-memory array (statebuffer="memory")
+                             or float32 memory mapped array
+                             (statebuffer="disk")
+
+        Notes:
+            If laststep is True the time dimension is 1,
+            i.e., [nvars, eTot, 1, nvec].
+            The in-memory buffer is analysis-ready (double precision)
+            and reused across cycles as long as the shape matches.
+            Every element is overwritten by load_statevector(),
+            thus it is not cleared between cycles.
+        """
+        if self.laststep:
+            nT = 1
+        shape = (len(self.statevars), self.eTot, nT, self.nvec)
+        if self.statebuffer == "disk":
+            # create buffer array, this is used for concatenating memmap objects.
+            buffer = np.memmap(self.dummyfile, dtype=np.float32, mode="w+",
+                               shape=shape)
+            return buffer
+        if self._statevector is None or self._statevector.shape != shape:
+            self._statevector = np.empty(shape, dtype=np.float64)
+        return self._statevector
+
+    def load_statevector(self, buffer, eNum, nT):
+        """
+        read files of a member and fill its part of the state vector.
+
+        Args:
+            buffer (np.ndarray-like): output of alloc_statevector()
+            eNum (int): ensemble member id
+            nT (int): number of time steps passed, or number of layers
+            (REC in Fortran) in your file.
+        """
+        for idx, var in enumerate(self.statevars):  # not that many
+            if self.statetype[idx] == "prognostic" and self.laststep:
+                # only the most rescent record is used in the analysis.
+                d = dau.load_record(os.path.join(self.outdir.format(eNum),
+                                                 "{0}.bin".format(var)
+                                                 ),
+                                    nT-1, self.nlat, self.nlon,
+                                    self.map2vec, self.nvec, dtype=np.float32,
+                                    vec2flat=self.vec2flat
+                                    )
+            elif self.statetype[idx] == "prognostic":
+                d = dau.load_data3d(os.path.join(self.outdir.format(eNum),
+                                                 "{0}.bin".format(var)
+                                                 ),
+                                    nT, self.nlat, self.nlon,
+                                    self.map2vec, self.nvec, dtype=np.float32,
+                                    vec2flat=self.vec2flat
+                                    )
+            else:  # parameter
+                d = dau.load_data3d(os.path.join(self.outdir.format(eNum),
+                                                 "param/",
+                                                 "{0}.bin".format(var)
+                                                 ),
+                                    1, self.nlat, self.nlon,
+                                    self.map2vec, self.nvec, dtype=np.float32,
+                                    vec2flat=self.vec2flat
+                                    )
+            if self.statedist[idx] == "log":
+                d[d==0] = 1e-8  # replace zero
+                np.log(d, out=buffer[idx, eNum, :, :])
+            elif self.statedist[idx] == "norm":
+                buffer[idx, eNum, :, :] = d
             else:
-                raise KeyError("undefined distribution: {0}".format(self.obsdist[idx]))
-            obs_values_all.append(obsall.reshape(1, -1))
-            obs_errors_all.append(errall.reshape(1, -1))
-        obs_date_values = np.vstack(obs_values_all)
-        obs_date_errors = np.vstack(obs_errors_all)
-        return obs_date_values, obs_date_errors
+                raise KeyError("undefined distribution: {0}".format(self.statedist[idx]))
+
+    def const_obs(self, obs, dates):
+        """
+        returns observations binned over the dates
+        from the observation store
+
+        Args:
+            obs (obsstore.ObservationStore): observation store built
+                                             in register()
+            dates (list-like): observation dates in this cycle
+
+        Returns:
+            np.ndarray: observation values [nobsvars, nvec]
+            np.ndarray: observation errors [nobsvars, nvec]
+
+        Notes:
+            values are already transformed by obsdist (e.g., log)
+            and undef where not observed. Where a reach is observed
+            more than once in the cycle, the latest observation is used,
+            as the state vector represents the end of the cycle.
+        """
+        return obs.get_window(dates)
 
     # postprocessing functions
-    def update_states(self, xa, nT, edate, dtype_f=camaout_dtype):
+    def update_states(self, xa, nT, edate, dtype_f=camaout_dtype, xp=None):
         """
         update current state based on assimilated results
         by saving files in outdir. Make sure that dtype_f
@@ -480,17 +898,49 @@ class AssimCama(object):
             dtype_f (np.dtype): data type you want to save.
                                 chose this carefully-this should be
                                 your model byte precision.
+            xp (np.ndarray): analysis with parameter noise at time nT
+                             [nvars, eTot, nReach]. None for no noise.
         """
-        ens0 = xa[1, 1, -1, :]
-        ens1 = xa[1, 2, -1, :]
-        print((ens0-ens1).sum())
-        argsmap = [[xa[:, eNum, -1, :], self.outdir.format(eNum), self.mapdir,
-                   self.nlon, self.nlat, nT, self.map2vec, self.vec2lat,
-                   self.vec2lon, eNum, self.nlfp, edate, dtype_f]
+        # publish the analysis once; workers read their member from it.
+        publish(self.xapath, xa[:, :, -1, :])
+        xppath = None
+        if xp is not None:
+            publish(self.xppath, xp)
+            xppath = self.xppath
+        argsmap = [[self.xapath, eNum, self.outdir.format(eNum), self.mapdir,
+                    self.nlon, self.nlat, nT, self.nlfp, edate, dtype_f,
+                    self.outstore is None, self.mapcachedir, xppath]
                    for eNum in range(self.eTot)]
-        p = Pool(self.nCPUs)
-        p.map(submit_update_states, argsmap)
-        p.close()
+        self.pool.map(submit_update_states, argsmap)
+
+    def archive_outputs(self, date, nT, dtype_f=camaout_dtype):
+        """
+        append river cells of this cycle's outputs of every member
+        to the output store, and remove the output binaries.
+        records of this cycle are dropped again if any member fails.
+
+        Args:
+            date (datetime.datetime): date of the first output record
+            nT (int): number of output records
+            dtype_f (np.dtype): data type of the outputs
+        """
+        t0 = self.outstore.extend(date, nT)
+        argslist = [[self.outdir.format(eNum), self.outvars, nT, self.nlat,
+                     self.nlon, self.mapcachedir, dtype_f]
+                    for eNum in range(self.eTot)]
+        try:
+            for eNum, data in self.pool.imap_unordered(
+                                    submit_vectorize_outputs, argslist):
+                self.outstore.write(eNum, t0, data)
+        except BaseException:
+            # do not leave zero-filled records with valid dates
+            self.outstore.truncate(date)
+            raise
+        self.outstore.flush()
+        for eNum in range(self.eTot):
+            outdir = self.outdir.format(eNum)
+            for var in self.outvars:
+                os.remove(os.path.join(outdir, "{0}.bin".format(var)))
 
 
 # multiprocessing; forwarding functions
@@ -501,14 +951,15 @@ def run_CaMa_(args):
     Args:
         args (list): arguments passed to run_CaMa
     Returns:
-        NoneType
+        float: wall time [s]
     """
-    run_CaMa(args[0], args[1], args[2], args[3], args[4], args[5],
-             ensrnof=args[6], restart=args[7])
+    with profiler.phase("forward", member=args[5]):
+        return run_CaMa(args[0], args[1], args[2], args[3], args[4], args[5],
+                        ensrnof=args[6], restart=args[7], nthreads=args[8])
 
 
 def run_CaMa(camagosh, modeldir, expname, rnofdir, simrange, eNum,
-             ensrnof=False, restart=True):
+             ensrnof=False, restart=True, nthreads=None):
     """
     execute cama-flood with in-code generated variable declaration
 
@@ -524,20 +975,78 @@ def run_CaMa(camagosh, modeldir, expname, rnofdir, simrange, eNum,
         restart (bool): True if restart from previous time restart file
                         This is usualy True, only pass False when you
                         want to do initial spinups.
+        nthreads (int): OpenMP threads of this member (OMP_NUM_THREADS).
+                        None to inherit the environment.
     Returns:
-        NoneType
+        float: wall time [s] of the model run
     """
     varspath = ext.make_vars(modeldir, expname, rnofdir, simrange, eNum,
                              ensrnof=ensrnof, restart=restart)
-    subprocess.check_call([camagosh, varspath])
+    env = os.environ.copy()
+    if nthreads is not None:
+        env["OMP_NUM_THREADS"] = str(nthreads)
+    stime = time.time()
+    subprocess.check_call([camagosh, varspath], env=env)
+    return time.time() - stime
 #
 
 
 # multiprocessing; postprocessing functions
+def publish(path, data):
+    """
+    save data as .npy to be memmapped by workers.
+
+    Args:
+        path (str): path to .npy
+        data (np.ndarray): array to publish
+    """
+    shared = np.lib.format.open_memmap(path, mode="w+", dtype=data.dtype,
+                                       shape=data.shape)
+    shared[:] = data
+    shared.flush()
+    del shared
+
+
 def submit_update_states(args):
     """
-    a wrapper to expand args.
+    a wrapper to expand args. The analysis of the member is read from
+    the memmapped array published by AssimCama.update_states(), and
+    vectorization index from the map cache.
+
+    Args:
+        args (list): xapath, eNum, outdir, mapdir, nlon, nlat, nT, nlfp,
+                     edate, dtype_f, rename, mapcachedir, xppath
+    """
+    (xapath, eNum, outdir, mapdir, nlon, nlat, nT, nlfp, edate, dtype_f,
+     rename, mapcachedir, xppath) = args
+    xa_each = np.load(xapath, mmap_mode="r")[:, eNum, :]
+    xp_each = None
+    if xppath is not None:
+        xp_each = np.load(xppath, mmap_mode="r")[:, eNum, :]
+    maps = mapcache.load(mapcachedir)
+    ext.update_states(xa_each, outdir, mapdir, nlon, nlat, nT,
+                      maps["map2vec"], maps["vec2lat"], maps["vec2lon"],
+                      eNum, nlfp, edate, dtype_f, rename=rename,
+                      mapcachedir=mapcachedir, vec2flat=maps["vec2flat"],
+                      xp_each=xp_each)
+
+
+def submit_vectorize_outputs(args):
+    """
+    read outputs of a member and vectorize those to river cells.
+
+    Args:
+        args (list): outdir, varnames, nT, nlat, nlon, mapcachedir, dtype_f
+
+    Returns:
+        np.ndarray: [nvars, nT, nvec]
     """
-    ext.update_states(args[0], args[1], args[2], args[3],
-                      args[4], args[5], args[6], args[7],
-                      args[8], args[9], args[10], args[11], args[12])
+    outdir, varnames, nT, nlat, nlon, mapcachedir, dtype_f = args
+    maps = mapcache.load(mapcachedir)
+    nvec = len(maps["vec2flat"])
+    data = np.empty([len(varnames), nT, nvec], dtype=dtype_f)
+    for idx, var in enumerate(varnames):
+        dau.load_data3d(os.path.join(outdir, "{0}.bin".format(var)), nT,
+                        nlat, nlon, maps["map2vec"], nvec, dtype=dtype_f,
+                        vec2flat=maps["vec2flat"], out=data[idx])
+    return data
@@ -0,0 +1,140 @@
+import datetime
+import numpy as np
+import pytz
+from obsstore import to_datetime64
+
+"""
+assimilation calendar used by AssimCama to find the next cycle.
+
+Dates are kept in a sorted, unique np.datetime64[ns] array so that the
+next assimilation date is found by binary search (np.searchsorted) in
+O(logn) instead of scanning the whole list every cycle.
+"""
+
+DAY_NS = 86400*10**9
+
+
+def to_datetime(date64):
+    """
+    convert np.datetime64 to utc aware datetime.datetime.
+    """
+    ns = int(np.datetime64(date64, "ns").astype(np.int64))
+    sec, rem = divmod(ns, 10**9)
+    dtdate = datetime.datetime(1970, 1, 1) + \
+        datetime.timedelta(seconds=sec, microseconds=rem//1000)
+    return pytz.utc.localize(dtdate)
+
+
+class AssimCalendar(object):
+    """
+    sorted set of assimilation dates.
+
+    Args:
+        dates (np.ndarray): np.datetime64 array of observation dates;
+                            need not be sorted or unique.
+        mingap (float): minimum gap between two assimilation cycles
+                        in days. Dates closer than this to the
+                        previously kept date are skipped. 0 to keep all.
+        cyclewindow (float): length of a cycle window in days.
+                             Dates within this window from the first
+                             date of a cycle are assimilated at once at
+                             the last date of the window. 0 for one
+                             cycle per date.
+    """
+
+    def __init__(self, dates, mingap=0, cyclewindow=0):
+        dates = np.unique(np.asarray(dates).astype("datetime64[ns]"))
+        self.mingap = float(mingap)
+        self.cyclewindow = int(round(float(cyclewindow)*DAY_NS))
+        if self.mingap > 0:
+            dates = self.merge_mingap(dates, self.mingap)
+        self.dates = dates
+
+    @classmethod
+    def from_dataset(cls, obsdset, mingap=0, cyclewindow=0):
+        """
+        construct calendar from time coordinate of observation dataset.
+
+        Args:
+            obsdset (xr.Dataset): observation dataset
+            mingap (float): minimum gap between cycles in days
+            cyclewindow (float): length of a cycle window in days
+
+        Returns:
+            AssimCalendar
+        """
+        return cls(obsdset["time"].values, mingap=mingap,
+                   cyclewindow=cyclewindow)
+
+    @staticmethod
+    def merge_mingap(dates, mingap):
+        """
+        drop dates closer than mingap days to the previously kept date.
+
+        Args:
+            dates (np.ndarray): sorted unique np.datetime64[ns] array
+            mingap (float): minimum gap in days
+
+        Returns:
+            np.ndarray: kept dates
+
+        Notes:
+            each step jumps to the first date beyond the gap with
+            searchsorted, so the cost is O(k logn) for k kept dates.
+        """
+        if len(dates) == 0:
+            return dates
+        ns = dates.astype(np.int64)
+        gap = int(round(mingap*DAY_NS))
+        keep = [0]
+        while True:
+            idx = np.searchsorted(ns, ns[keep[-1]]+gap, side="left")
+            if idx >= len(ns):
+                break
+            keep.append(idx)
+        return dates[keep]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, idx):
+        return to_datetime(self.dates[idx])
+
+    def next_date(self, date):
+        """
+        returns the end of the next assimilation cycle after date.
+        this is the first assimilation date strictly after date,
+        or the last date within cyclewindow from it if cyclewindow > 0.
+
+        Args:
+            date (datetime.datetime): utc aware date
+
+        Returns:
+            datetime.datetime: utc aware date
+
+        Raises:
+            IndexError: no assimilation date after date
+        """
+        idx = np.searchsorted(self.dates, to_datetime64(date), side="right")
+        if idx >= len(self.dates):
+            raise IndexError("no assimilation date after {0}"
+                             .format(date.strftime("%Y%m%d%H")))
+        if self.cyclewindow > 0:
+            wend = self.dates[idx] + np.timedelta64(self.cyclewindow, "ns")
+            idx = np.searchsorted(self.dates, wend, side="right") - 1
+        return to_datetime(self.dates[idx])
+
+    def window(self, sdate, edate):
+        """
+        returns assimilation dates in (sdate, edate].
+
+        Args:
+            sdate (datetime.datetime): utc aware date, excluded
+            edate (datetime.datetime): utc aware date, included
+
+        Returns:
+            np.ndarray: np.datetime64[ns] array (view)
+        """
+        sidx = np.searchsorted(self.dates, to_datetime64(sdate), side="right")
+        eidx = np.searchsorted(self.dates, to_datetime64(edate), side="right")
+        return self.dates[sidx:eidx]
@@ -6,6 +6,8 @@ import subprocess
 import datetime
 import dautils as dau
 import calc_storage
+import mapcache
+import profiler
 
 """
 a set of case-specific functions.
@@ -34,10 +36,31 @@ string = "\nThis extention is desined for caseCode {0}.\n" +\
          "and dependnt modules"
 warnings.warn(string.format(caseCode, svals[0], svals[1], svals[2]))
 
+# regression parameters of river wetted perimeter parameters (rivbta),
+# taken from fsrc/calc_rivbta.F90. [beta1-4, g1-8]; g1-8 are
+# coefficients of [1, sp**-1, sp**-2, sp**-3, sp, sp**2, sp**3, sp**0.5]
+rivbta_params = np.array([
+    [0.328523411998739, -0.136629598093381, 0.226782890677302,
+     0.407317315366405, 0.0573936111784235, -0.000827027398309836,
+     7.73363755705211e-06, -0.218593761377831],
+    [-1.73499845293949, 1.86961902684339, -0.0787095731609086,
+     -1.70280956920105, -0.236031863429058, 0.00114799994407101,
+     3.43885058357733e-06, 1.73575973862887],
+    [-0.0914107976436178, 0.0400444500138610, 0.387741337558434,
+     -0.152454059221963, -0.0859683978597510, 0.00121037617690324,
+     -1.24573143624190e-05, 0.515523126751616],
+    [0.440010360908978, -0.291924093276058, 0.00781944059584046,
+     0.0164084553274571, 0.0337017710333279, -0.000464008615742078,
+     4.69370047950512e-06, -0.204804996998889]
+    ], dtype=np.float32)
+
+# width classes of the prior information
+widthclasspath = "/home/yi79a/yuta/RiDiA/data/MS-RiDiA/rawdata/priorinfo/WidthsClass.csv"
+
 
 # utilities-initialization functions
-def gain_perturbation(var, outdir, mapdir, nlat, nlon, eTot,
-                      dtype_f=np.float32):
+def gain_perturbation(var, outdir, mapdir, nlat, nlon, eTot, vec2flat,
+                      dtype_f=np.float32, rng=None):
     """
     get perturbated initial parameters and save those in outdir file.
     You should save every parameters in state variables in outdir.
@@ -47,13 +70,18 @@ def gain_perturbation(var, outdir, mapdir, nlat, nlon, eTot,
         nlat (int): number of latitudinal grid cells
         nlon (int): number of longitudinal grid cells
         eTot (int): total number of ensemble members
+        vec2flat (np.ndarray): output of dautils.make_flatIndex();
+                               river cells of rivhgt and rivbta.
         dtype_f (np.dtype): float data type you want to save;
                             must be similar to model data type.
+        rng (numpy.random.Generator): random number generator.
+                                      pass a seeded one for reproducible
+                                      initial ensembles.
     """
+    if rng is None:
+        rng = np.random.default_rng()
     # read background prior information
-    widthclass = pd.read_csv("/home/yi79a/yuta/RiDiA/data/MS-RiDiA/rawdata/priorinfo/WidthsClass.csv", index_col=0)
-    # convert from loged value to normal value
-    widthMed = widthclass["50%"].apply(lambda x: np.exp(x)).tolist()
+    widthMed = get_width_medians()
     widths2d = np.memmap(os.path.join(mapdir, "rivwth_gwdlr.bin"),
                          dtype=dtype_f, shape=(nlat, nlon), mode="r")
     if var == "rivman":
@@ -61,13 +89,19 @@ def gain_perturbation(var, outdir, mapdir, nlat, nlon, eTot,
         nLogMean = nclass["mean"].tolist()
         nLogStd = nclass["std"].tolist()
         outarray = get_map2d_from_lognormal(widths2d, widthMed,
-                                            nLogMean, nLogStd, 0.005, 1.0, eTot)
+                                            nLogMean, nLogStd, 0.005, 1.0, eTot,
+                                            rng=rng)
     elif var == "rivshp":
         sclass = pd.read_csv("/home/yi79a/yuta/RiDiA/data/MS-RiDiA/rawdata/priorinfo/priorsRClass.csv", index_col=0)
         sLogMean = sclass["mean"].tolist()
         sLogStd = sclass["std"].tolist()
         outarray = get_map2d_from_lognormal(widths2d, widthMed,
-                                            sLogMean, sLogStd, 1, 20, eTot)
+                                            sLogMean, sLogStd, 1, 20, eTot,
+                                            rng=rng)
+    elif var == "rivhgt":
+        outarray = get_rivhgt2d(mapdir, nlat, nlon, eTot, vec2flat,
+                                hc_logmean=-2.3, hc_logstd=1.17,
+                                hp_min=0.3, hp_max=0.7, rng=rng)
     # deprecated
     # elif var == "rivhgt":
     #     rivhgt2d = np.memmap(os.path.join(mapdir, "rivhgt.bin"), dtype=dtype_f,
@@ -84,84 +118,214 @@ def gain_perturbation(var, outdir, mapdir, nlat, nlon, eTot,
             os.makedirs(bkupdir)
         fn = "{0}.bin".format(var)
         if e == 0:
-            # copy original map
-            subprocess.check_call(["cp", os.path.join(mapdir, "rivhgt.bin"),
-                                   os.path.join(bkupdir, "rivhgt.bin")])
-            subprocess.check_call(["cp", os.path.join(mapdir, "rivman.bin"),
-                                   os.path.join(bkupdir, "rivman.bin")])
-            subprocess.check_call(["cp", os.path.join(mapdir, "rivshp.bin"),
-                                   os.path.join(bkupdir, "rivshp.bin")])
-            subprocess.check_call(["cp", os.path.join(mapdir, "rivbta.bin"),
-                                   os.path.join(bkupdir, "rivbta.bin")])
-            subprocess.check_call(["cp", os.path.join(mapdir, "rivhgt.bin"),
-                                   os.path.join(paramdir, "rivhgt.bin")])
-            subprocess.check_call(["cp", os.path.join(mapdir, "rivman.bin"),
-                                   os.path.join(paramdir, "rivman.bin")])
-            subprocess.check_call(["cp", os.path.join(mapdir, "rivshp.bin"),
-                                   os.path.join(paramdir, "rivshp.bin")])
-            subprocess.check_call(["cp", os.path.join(mapdir, "rivbta.bin"),
-                                   os.path.join(paramdir, "rivbta.bin")])
+            # stage original map;
+            # init/ is never written, so it is a read-only copy sharing
+            # blocks with mapdir where reflink is supported; mapdir is
+            # left as is. param/ is updated every cycle, so it is writable.
+            for mapfn in ["rivhgt.bin", "rivman.bin", "rivshp.bin",
+                          "rivbta.bin"]:
+                dau.stage_file(os.path.join(mapdir, mapfn),
+                               os.path.join(bkupdir, mapfn), share=True)
+                dau.stage_file(os.path.join(mapdir, mapfn),
+                               os.path.join(paramdir, mapfn))
             continue
-        if var == "rivhgt":
-            get_rivhgt2d(mapdir, bkupdir, paramdir, fn, nlat, nlon,
-                         hc_logmean=-2.3, hc_logstd=1.17, hp_min=0.3, hp_max=0.7)
-        else:
-            sf = outarray[e].flatten().astype(dtype_f)
-            sf.tofile(os.path.join(paramdir, fn))
-            sf.tofile(os.path.join(bkupdir, fn))
+        sf = outarray[e].flatten().astype(dtype_f)
+        sf.tofile(os.path.join(paramdir, fn))
+        sf.tofile(os.path.join(bkupdir, fn))
         print("output parameter file: {0}".format(os.path.join(paramdir, fn)))
         print("backup parameter file: {0}".format(os.path.join(bkupdir, fn)))
 
         if var == "rivshp":
-            crivshp = os.path.join(paramdir, fn)
-            crivbta = os.path.join(paramdir, "rivbta.bin")
-            cnextxy = os.path.join(mapdir, "nextxy.bin")
-            print("output parameter file: {0}".format(os.path.join(paramdir, "rivbta.bin")))
-            subprocess.check_call(["/home/yi79a/yuta/RiDiA/srcda/MS-RiDiA/fsrc/calc_rivbta", crivshp, crivbta,
-                                  cnextxy, str(nlon), str(nlat)])
-            print("backup parameter file: {0}".format(os.path.join(bkupdir, "rivbta.bin")))
-            subprocess.check_call(["cp", os.path.join(paramdir, "rivbta.bin"),
-                                   os.path.join(bkupdir, "rivbta.bin")])
+            # same cells as save_rivbta() in update_states()
+            for bdir in [paramdir, bkupdir]:
+                print("output parameter file: {0}".format(os.path.join(bdir, "rivbta.bin")))
+                save_rivbta(sf[vec2flat], os.path.join(bdir, "rivbta.bin"),
+                            nlat, nlon, vec2flat, dtype_f=dtype_f)
+
+
+def get_rivermask(vec2flat, nlat, nlon):
+    """
+    returns river cells (cells in vectors) as a boolean 2d map
+    [nlat, nlon]. river cells of parameters are the vector domain,
+    so that every parameter and rivbta are defined on the same cells.
+
+    Args:
+        vec2flat (np.ndarray): output of dautils.make_flatIndex()
+        nlat (int): number of latitudinal grid cells
+        nlon (int): number of longitudinal grid cells
+    """
+    rivermask = np.zeros(nlat*nlon, dtype=bool)
+    rivermask[vec2flat] = True
+    return rivermask.reshape(nlat, nlon)
+
+
+def calc_rivbta(rivshp):
+    """
+    in-process, vectorized version of fsrc/calc_rivbta.F90.
+    evaluates the regression polynomial of the river wetted perimeter
+    parameters at every element of rivshp.
+
+    Args:
+        rivshp (np.ndarray): river cross section shape parameter
+                             at river cells; any shape (e.g., [nvec]).
+
+    Returns:
+        np.ndarray: [4, *rivshp.shape] rivbta, single precision
+                    as in the Fortran version.
+    """
+    sp = np.asarray(rivshp, dtype=np.float32)
+    terms = [np.ones_like(sp), sp**(-1.), sp**(-2.), sp**(-3),
+             sp, sp**(2.), sp**(3.), sp**(0.5)]
+    rivbta = np.zeros((4,) + sp.shape, dtype=np.float32)
+    for ig, term in enumerate(terms):
+        rivbta += rivbta_params[:, ig].reshape((4,) + (1,)*sp.ndim) * term
+    return rivbta
+
+
+def save_rivbta(rivshp, outpath, nlat, nlon, vec2flat, dtype_f=np.float32):
+    """
+    write 4-record rivbta.bin from rivshp in vector format.
+    Cells not in vectors (non-river) are -9999 as in calc_rivbta.F90.
+
+    Args:
+        rivshp (np.ndarray): [nvec] rivshp in vector format
+        outpath (str): path to rivbta.bin
+        nlat (int): number of latitudinal grid cells
+        nlon (int): number of longitudinal grid cells
+        vec2flat (np.ndarray): output of dautils.make_flatIndex()
+        dtype_f (np object): data type for float in numpy object
+    """
+    data = np.memmap(outpath, dtype=dtype_f, shape=(4, nlat, nlon),
+                     mode="w+")
+    dau.revert_map_into(calc_rivbta(rivshp), vec2flat, data, fill=-9999)
+    del data
+
+
+def get_width_medians(path=widthclasspath):
+    """
+    returns median width of each class from the prior information.
+
+    Args:
+        path (str): csv of width classes; "50%" is log of the median
+
+    Returns:
+        list: median width of each class
+    """
+    widthclass = pd.read_csv(path, index_col=0)
+    # convert from loged value to normal value
+    return widthclass["50%"].apply(lambda x: np.exp(x)).tolist()
+
+
+def get_width_class(widths, widthMed):
+    """
+    assign width classes; the class whose median is the nearest.
+
+    Args:
+        widths (np.ndarray): river widths, any shape
+        widthMed (list): median width of each class
+
+    Returns:
+        np.ndarray: class index for each width, same shape as widths.
+
+    Notes:
+        one searchsorted over sorted class medians. Ties go to the smaller
+        median, which is the same as argmin when medians are ascending.
+    """
+    widthMed = np.asarray(widthMed, dtype=np.float64)
+    order = np.argsort(widthMed, kind="stable")
+    sortedMed = widthMed[order]
+    widths = np.asarray(widths, dtype=np.float64)
+    right = np.searchsorted(sortedMed, widths)
+    right = np.clip(right, 0, len(sortedMed)-1)
+    left = np.clip(right-1, 0, len(sortedMed)-1)
+    useleft = (np.absolute(widths - sortedMed[left]) <=
+               np.absolute(sortedMed[right] - widths))
+    return order[np.where(useleft, left, right)]
 
 
-#@jit
 def get_map2d_from_lognormal(widths2d, widthMed,
-                             paramLogMean, paramLogStd, min, max, eTot, undef=-9999):
+                             paramLogMean, paramLogStd, min, max, eTot, undef=-9999,
+                             rng=None):
     """
     get purterbated 2dmap from lognormal distribution.
+
+    Args:
+        widths2d (np.ndarray): river width map [nlat, nlon]
+        widthMed (list): median width of each class
+        paramLogMean (list): mean of underlying normal dist. of each class
+        paramLogStd (list): std of underlying normal dist. of each class
+        min (float): lower bound of samples
+        max (float): upper bound of samples
+        eTot (int): total number of ensemble members
+        undef (int): undefined value in widths2d
+        rng (numpy.random.Generator): random number generator
+
+    Returns:
+        np.ndarray: [eTot, nlat, nlon]
+
+    Notes:
+        classes are assigned with one searchsorted and all
+        [eTot, ncells] samples are drawn in one call.
     """
+    if rng is None:
+        rng = np.random.default_rng()
     nlat = widths2d.shape[0]
     nlon = widths2d.shape[1]
-    outarray = np.zeros([eTot, nlat, nlon])
-    for ilat in range(nlat):
-        for ilon in range(nlon):
-            width = widths2d[ilat, ilon]
-            if width == undef:
-                outarray[:, ilat, ilon] = undef
-                continue
-            idx = np.argmin(np.absolute(np.array(widthMed) - width))
-            mean = paramLogMean[idx]
-            std = paramLogStd[idx]
-            out = np.random.lognormal(mean, std, size=eTot)
-            # out = np.exp(logwths)
-            out[out > max] = max
-            out[out < min] = min
-            outarray[:, ilat, ilon] = out
-    return outarray
+    widths = np.asarray(widths2d).reshape(-1)
+    valid = (widths != undef)
+    idx = get_width_class(widths[valid], widthMed)
+    mean = np.asarray(paramLogMean, dtype=np.float64)[idx]
+    std = np.asarray(paramLogStd, dtype=np.float64)[idx]
+    out = rng.lognormal(mean, std, size=(eTot, len(idx)))
+    np.clip(out, min, max, out=out)
+    outarray = np.ones([eTot, nlat*nlon])*undef
+    outarray[:, valid] = out
+    return outarray.reshape(eTot, nlat, nlon)
+
+
+def get_rivhgt2d(mapdir, nlat, nlon, eTot, vec2flat,
+                 hc_logmean=-2.3, hc_logstd=1.17, hp_min=0.4, hp_max=0.6,
+                 ho=0.0, hmin=0.5, undef=-9999, rng=None):
+    """
+    get perturbated river height maps for all ensemble members at once.
+    in-process, batched version of fsrc/calc_rivhgt.F90:
+        H = max(HMIN, HC*Qave**HP + HO)
+    where (HC, HP) are drawn for each member.
 
+    Args:
+        mapdir (str): map directory containing outclm.bin
+        nlat (int): number of latitudinal grid cells
+        nlon (int): number of longitudinal grid cells
+        eTot (int): total number of ensemble members
+        vec2flat (np.ndarray): output of dautils.make_flatIndex();
+                               river cells are the vector domain.
+        hc_logmean (float): mean of underlying normal distribution of HC
+        hc_logstd (float): std of underlying normal distribution of HC
+        hp_min (float): lower bound of uniform distribution of HP
+        hp_max (float): upper bound of uniform distribution of HP
+        ho (float): offset HO
+        hmin (float): minimum height HMIN
+        rng (numpy.random.Generator): random number generator
 
-def get_rivhgt2d(mapdir, bkupdir, paramdir, fn, nlat, nlon,
-                 hc_logmean=-2.3, hc_logstd=-1.17, hp_min=0.4, hp_max=0.6):
-    cnextxy = os.path.join(mapdir, "nextxy.bin")
-    crivout = os.path.join(mapdir, "outclm.bin")
-    crivhgt = os.path.join(paramdir, fn)
-    hc = np.random.lognormal(hc_logmean, hc_logstd, 1)[0]
-    hp = np.random.uniform(hp_min, hp_max, 1)[0]
-    subprocess.check_call(["/home/yi79a/yuta/RiDiA/srcda/MS-RiDiA/fsrc/calc_rivhgt", crivout, crivhgt,
-                          cnextxy, str(hc), str(hp),
-                          str(nlon), str(nlat)])
-    subprocess.check_call(["cp", os.path.join(paramdir, "rivhgt.bin"),
-                           os.path.join(bkupdir, "rivhgt.bin")])
+    Returns:
+        np.ndarray: [eTot, nlat, nlon] river height; undef at non-river cells.
+
+    Notes:
+        climatological discharge is read and the river mask is made once
+        for the whole ensemble.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    rivermask = get_rivermask(vec2flat, nlat, nlon)
+    rivout = np.fromfile(os.path.join(mapdir, "outclm.bin"), dtype=np.float32,
+                         count=nlat*nlon).reshape(nlat, nlon)
+    qave = rivout[rivermask].astype(np.float64)
+    hc = rng.lognormal(hc_logmean, hc_logstd, size=eTot)
+    hp = rng.uniform(hp_min, hp_max, size=eTot)
+    outarray = np.ones([eTot, nlat, nlon])*undef
+    outarray[:, rivermask] = np.maximum(hmin, hc.reshape(-1, 1) *
+                                        qave**hp.reshape(-1, 1) + ho)
+    return outarray
 
 
 #@jit
@@ -250,7 +414,9 @@ def make_vars(modeldir, expname, rnofdir, simrange, eNum,
 
 # multiprocessing; post-processing functions
 def update_states(xa_each, outdir, mapdir, nlon, nlat, nt, map2vec, vec2lat,
-                  vec2lon, eNum, nlfp, edate, dtype_f=np.float32):
+                  vec2lon, eNum, nlfp, edate, dtype_f=np.float32,
+                  rename=True, mapcachedir=None, vec2flat=None,
+                  xp_each=None):
     """
     update parameters from assimilated state vectors
 
@@ -264,33 +430,82 @@ def update_states(xa_each, outdir, mapdir, nlon, nlat, nt, map2vec, vec2lat,
         eNum (int): ensemble member id
         nlfp (int): number of flood plain layers
         dtype_f (np object): data type for float in numpy object
+        rename (bool): True to keep outputs as <var>_YYYYMMDD.bin.
+                       False if outputs are archived in an output store
+                       (see outstore.py) by the caller.
+        mapcachedir (str): map cache built by mapcache.build()
+        vec2flat (np.ndarray): output of dautils.make_flatIndex().
+                               computed if None.
+        xp_each (np.ndarray): analysis with parameter noise (nvars, nReach).
+                              None for no noise.
 
     Returns:
         None
     """
-    save_updates(xa_each, outdir, nlon, nlat, nt, vec2lat, vec2lon, dtype_f)
-    rewrite_restart(outdir, mapdir, nlon, nlat, nt, map2vec, vec2lat, vec2lon,
-                    nlfp, dtype_f=dtype_f)
-    # write new rivbta.bin based on new rivshp.bin
-    crivshp = os.path.join(outdir, "param", "rivshp.bin")
-    crivbta = os.path.join(outdir, "param", "rivbta.bin")
-    cnextxy = os.path.join(mapdir, "nextxy.bin")
-    subprocess.check_call(["/home/yi79a/yuta/RiDiA/srcda/MS-RiDiA/fsrc/calc_rivbta", crivshp, crivbta, cnextxy, str(nlon), str(nlat)])
-
-    # add noise to avoid convergence
-    add_noise(xa_each, outdir, nlon, nlat, nt, map2vec,
-              vec2lat, vec2lon, dtype_f)
+    if vec2flat is None:
+        vec2flat = dau.make_flatIndex(vec2lat, vec2lon, nlon)
+    # write analysis; parameters with noise to avoid convergence
+    with profiler.phase("write_analysis", member=eNum):
+        analysis = write_analysis(xa_each, outdir, nlon, nlat, nt, vec2flat,
+                                  dtype_f, xp_each=xp_each)
+    # initial conditions from analysis before noise
+    with profiler.phase("rewrite_restart", member=eNum):
+        rewrite_restart(outdir, mapdir, nlon, nlat, nt, map2vec, vec2lat,
+                        vec2lon, nlfp, dtype_f=dtype_f, vec2flat=vec2flat,
+                        mapcachedir=mapcachedir,
+                        rivshp=analysis["rivshp"][0],
+                        outwth=analysis["outwth"][0])
+    # write new rivbta.bin based on new rivshp
+    with profiler.phase("rivbta", member=eNum):
+        save_rivbta(analysis["rivshp"][0],
+                    os.path.join(outdir, "param", "rivbta.bin"),
+                    nlat, nlon, vec2flat, dtype_f=dtype_f)
 
     # rename files
-    for var in ["outflw.bin", "outwth.bin", "flddph.bin"]:
-        outname = "{0}_{1}.bin".format(var.split(".")[0],
-                                       edate.strftime("%Y%m%d"))
-        subprocess.check_call(["mv", os.path.join(outdir, var),
-                               os.path.join(outdir, outname)])
+    if rename:
+        for var in ["outflw.bin", "outwth.bin", "flddph.bin"]:
+            outname = "{0}_{1}.bin".format(var.split(".")[0],
+                                           edate.strftime("%Y%m%d"))
+            subprocess.check_call(["mv", os.path.join(outdir, var),
+                                   os.path.join(outdir, outname)])
+
+
+_storage_maps = {}
+
+
+def get_storage_maps(mapdir, nlat, nlon, map2vec, nvec, nlfp,
+                     mapcachedir=None):
+    """
+    returns vectorized static maps used in storage inversion and
+    cumulative floodplain tables (see mapcache.py).
+
+    Args:
+        mapdir (str): map directory
+        nlat (int): number of latitudinal grid cells
+        nlon (int): number of longitudinal grid cells
+        map2vec (np.ndarray): 2d index to vecid
+        nvec (int): length of whole vector
+        nlfp (int): number of flood plain layers
+        mapcachedir (str): map cache built by mapcache.build().
+                           None to read maps from mapdir
+                           (memoized per process).
+
+    Returns:
+        dict: rivwth, rivlen, rivhgt, grarea [nvec], fldgrd [nlfp, nvec],
+              wthtab, dphtab [nlfp, nvec]
+    """
+    if mapcachedir is not None:
+        return mapcache.load(mapcachedir)
+    key = (mapdir, nlfp)
+    if key not in _storage_maps:
+        _storage_maps[key] = mapcache.vectorize_static(mapdir, nlat, nlon,
+                                                       map2vec, nvec, nlfp)
+    return _storage_maps[key]
 
 
 def rewrite_restart(outdir, mapdir, nlon, nlat, nt, map2vec, vec2lat, vec2lon,
-                    nlfp=10, dtype_f=np.float32):
+                    nlfp=10, dtype_f=np.float32, vec2flat=None,
+                    mapcachedir=None, rivshp=None, outwth=None):
     """
     re-write restart file (storage-only) to update initial condition
     after assimilation based on flow width.
@@ -305,6 +520,12 @@ def rewrite_restart(outdir, mapdir, nlon, nlat, nt, map2vec, vec2lat, vec2lon,
         nt (int): number of time (first dimension) for sim. output files
         nlfp (int): number of flood plain layers
         dtype_f (np object): data type for float in numpy object
+        vec2flat (np.ndarray): output of dautils.make_flatIndex()
+        mapcachedir (str): map cache built by mapcache.build()
+        rivshp (np.ndarray): analysis rivshp [nvec]. read from
+                             param/rivshp.bin if None.
+        outwth (np.ndarray): analysis outwth [nvec]. read from the last
+                             record of outwth.bin if None.
 
     Returns:
         NoneType
@@ -319,147 +540,97 @@ def rewrite_restart(outdir, mapdir, nlon, nlat, nt, map2vec, vec2lat, vec2lon,
         passed.
     """
     nvec = len(vec2lat)
-    # load data in vectorized format
-    rivwth = dau.load_data3d(os.path.join(mapdir, "rivwth_gwdlr.bin"),
-                             1, nlat, nlon, map2vec, nvec, dtype=np.float32)[0]
-    rivlen = dau.load_data3d(os.path.join(mapdir, "rivlen.bin"),
-                             1, nlat, nlon, map2vec, nvec, dtype=np.float32)[0]
-    rivhgt = dau.load_data3d(os.path.join(mapdir, "rivhgt.bin"),
-                             1, nlat, nlon, map2vec, nvec, dtype=np.float32)[0]
-    grarea = dau.load_data3d(os.path.join(mapdir, "ctmare.bin"),
-                             1, nlat, nlon, map2vec, nvec, dtype=np.float32)[0]
-    fldgrd = dau.load_data3d(os.path.join(mapdir, "fldgrd.bin"),
-                             nlfp, nlat, nlon, map2vec, nvec,
-                             dtype=np.float32)[:]
+    if vec2flat is None:
+        vec2flat = dau.make_flatIndex(vec2lat, vec2lon, nlon)
+    # static maps and floodplain tables; only member-specific
+    # rivshp and outwth are read here.
+    smaps = get_storage_maps(mapdir, nlat, nlon, map2vec, nvec, nlfp,
+                             mapcachedir=mapcachedir)
     # after assimilation file is saved
-    rivshp = dau.load_data3d(os.path.join(outdir, "param/rivshp.bin"),
-                             1, nlat, nlon, map2vec, nvec, dtype=np.float32)[0]
-    outwth = dau.load_data3d(os.path.join(outdir, "outwth.bin"),
-                             nt, nlat, nlon, map2vec, nvec, dtype=np.float32)[-1]
-    storage = calc_storage.get_storage_invertsely(outwth, rivwth, rivlen, rivhgt,
-                                                  rivshp, grarea, fldgrd, nvec,
-                                                  nlfp=nlfp, undef=-9999)
-    restart = np.zeros([2, nlat, nlon])
-    restart[0] = dau.revert_map(storage[0].reshape(1, nvec),
-                                vec2lat, vec2lon, nlat, nlon)[0]
-    restart[1] = dau.revert_map(storage[1].reshape(1, nvec),
-                                vec2lat, vec2lon, nlat, nlon)[0]
-    restart.flatten().astype(dtype_f).tofile(
-                                             os.path.join(outdir, "restart.bin")
-                                             )
-
-
-def save_updates(xa_each, outdir, nlon, nlat, nt, vec2lat, vec2lon, dtype_f):
+    if rivshp is None:
+        rivshp = dau.load_data3d(os.path.join(outdir, "param/rivshp.bin"),
+                                 1, nlat, nlon, map2vec, nvec,
+                                 dtype=np.float32, vec2flat=vec2flat)[0]
+    if outwth is None:
+        outwth = dau.load_record(os.path.join(outdir, "outwth.bin"), nt-1,
+                                 nlat, nlon, map2vec, nvec,
+                                 dtype=np.float32, vec2flat=vec2flat)[0]
+    storage = calc_storage.get_storage_invertsely(outwth, smaps["rivwth"],
+                                                  smaps["rivlen"],
+                                                  smaps["rivhgt"],
+                                                  rivshp, smaps["grarea"],
+                                                  smaps["fldgrd"], nvec,
+                                                  nlfp=nlfp, undef=-9999,
+                                                  wthtab=smaps["wthtab"],
+                                                  dphtab=smaps["dphtab"])
+    # [rivsto, fldsto] in one scatter
+    restart = np.memmap(os.path.join(outdir, "restart.bin"), dtype=dtype_f,
+                        shape=(2, nlat, nlon), mode="w+")
+    dau.revert_map_into(storage, vec2flat, restart, fill=1e+20)
+    del restart
+
+
+# analysis variables; [name, index in xa_each, lower bound of analysis,
+# lower and upper bound after noise]
+analysis_params = [["rivhgt", 1, 1, 0.5, 20],
+                   ["rivman", 2, 0.01, 0.01, 5],
+                   ["rivshp", 3, 1, 1, 20]]
+
+
+def write_analysis(xa_each, outdir, nlon, nlat, nt, vec2flat, dtype_f,
+                   xp_each=None):
     """
-    save analysis onto file in outdir.
+    write analysis onto files in outdir in a single pass.
+    The last record of outwth.bin and each param/*.bin are written
+    exactly once with one scatter per file.
 
     Args:
         xa_each (np.ndarray): analysis array at time nt of eNum (nvars, nReach)
                               nvars are in order of:
-                                [outwth, rivman, rivshp]
+                                [outwth, rivhgt, rivman, rivshp]
         outdir (str): out directory
         nlon (int): number of longitudinal grid cells
         nlat (int): number of latitudinal grid cells
         nt (int): number of time (first dimension) for sim. output files
+        vec2flat (np.ndarray): output of dautils.make_flatIndex()
         dtype_f (np object): data type for float in numpy object
+        xp_each (np.ndarray): analysis with parameter noise (nvars, nReach)
+                              drawn in the driver process (inflation.py).
+                              None to write parameters without noise.
+
+    Returns:
+        dict: analysis in vector format {var: [1, nvec]}, before noise.
+              used to update initial conditions (rewrite_restart).
 
-    ToDo:
-        Maybe add disturbance on parameters?
+    Notes:
+        values are transformed in vector space (xa is vector, so there
+        is no undef). Parameters written are the noised ones, clipped
+        to their bounds; analysis before noise is returned.
     """
-    nvec = len(vec2lat)
-    # update outwth
+    analysis = {}
+    # update the last record of outwth
+    vec = np.exp(xa_each[0:1, :].astype(dtype_f))  # log
+    itemsize = np.dtype(dtype_f).itemsize
     data = np.memmap(os.path.join(outdir, "outwth.bin"), dtype=dtype_f,
-                     shape=(nt, nlat, nlon), mode="r+")  # use carefully!
-    tmp = dau.revert_map(xa_each[0, :].astype(dtype_f).reshape(1, nvec),
-                         vec2lat, vec2lon, nlat, nlon)[0]
-    undefloc = (tmp == 1e+20)
-    tmp[undefloc] = 1
-    tmp = np.exp(tmp)  # log
-    tmp[undefloc] = 1e+20
-    data[-1, :, :] = tmp[:, :]
+                     shape=(1, nlat, nlon), mode="r+",
+                     offset=(nt-1)*nlat*nlon*itemsize)  # use carefully!
+    dau.revert_map_into(vec, vec2flat, data, fill=1e+20)
     del data  # closing and flushing changes to disk
+    analysis["outwth"] = vec
+
+    # parameters
+    for var, idx, minv, nminv, nmaxv in analysis_params:
+        vec = np.exp(xa_each[idx:idx+1, :].astype(dtype_f))
+        vec[vec < minv] = minv
+        analysis[var] = vec
+        if xp_each is not None:
+            # noise is applied in double precision
+            vec = np.clip(np.exp(xp_each[idx:idx+1, :]), nminv, nmaxv)
+        data = np.memmap(os.path.join(outdir, "param/{0}.bin".format(var)),
+                         dtype=dtype_f, shape=(1, nlat, nlon),
+                         mode="w+")  # use carefully!
+        dau.revert_map_into(vec, vec2flat, data, fill=-9999)
+        del data
+    return analysis
 
-    data0 = np.memmap(os.path.join(outdir, "param/rivhgt.bin"), dtype=dtype_f,
-                      shape=(nlat, nlon), mode="w+")  # use carefully!
-    tmp = dau.revert_map(xa_each[1, :].astype(dtype_f).reshape(1, nvec),
-                         vec2lat, vec2lon, nlat, nlon)[0]
-    undefloc = (tmp == 1e+20)
-    tmp[undefloc] = 1  # just to avoid overflow
-    tmp = np.exp(tmp)
-    tmp[tmp < 1] = 1
-    tmp[undefloc] = -9999
-    data0[:, :] = tmp[:, :]
-    del data0
-
-    data1 = np.memmap(os.path.join(outdir, "param/rivman.bin"), dtype=dtype_f,
-                      shape=(nlat, nlon), mode="w+")  # use carefully!
-    tmp = dau.revert_map(xa_each[2, :].astype(dtype_f).reshape(1, nvec),
-                         vec2lat, vec2lon, nlat, nlon)[0]
-    undefloc = (tmp == 1e+20)
-    tmp[undefloc] = 1
-    tmp = np.exp(tmp)
-    tmp[tmp < 0.01] = 0.01
-    tmp[undefloc] = -9999
-    data1[:, :] = tmp[:, :]
-    del data1
-
-    data2 = np.memmap(os.path.join(outdir, "param/rivshp.bin"), dtype=dtype_f,
-                      shape=(nlat, nlon), mode="w+")  # use carefully!
-    tmp = dau.revert_map(xa_each[3, :].astype(dtype_f).reshape(1, nvec), vec2lat, vec2lon, nlat, nlon)[0]
-    undefloc = (tmp == 1e+20)
-    tmp[undefloc] = 1
-    tmp = np.exp(tmp)
-    tmp[tmp < 1] = 1
-    tmp[undefloc] = -9999
-    data2[:, :] = tmp[:, :]
-    del data2
-
-
-def multiply_normalnoise(vec, std, minv, maxv):
-    np.random.seed(int.from_bytes(os.urandom(4), byteorder='little'))
-    noise = np.random.normal(1, std, 1)
-    if noise < minv:
-        noise = minv
-    elif noise > maxv:
-        noise = maxv
-    print(noise, (vec*noise).min(), (vec*noise).max())
-    return vec*noise
-
-
-def add_noise(xa_each, outdir, nlon, nlat, nt, map2vec, vec2lat, vec2lon, dtype_f):
-    """
-    add noise for next loop.
-    Tweaking needed.
-    """
-    nvec = len(vec2lat)
-    xa_each = np.exp(xa_each)  # its log; xa is vector, so there is no undef.
-    data0 = np.memmap(os.path.join(outdir, "param/rivhgt.bin"), dtype=dtype_f,
-                      shape=(nlat, nlon), mode="r+")  # use carefully!
-    next0 = multiply_normalnoise(xa_each[1, :], 0.25, 0.5, 1.5)
-    tmp = dau.revert_map(next0.astype(dtype_f).reshape(1, nvec), vec2lat, vec2lon, nlat, nlon)[0]
-    tmp[tmp < 0.5] = 0.5
-    tmp[tmp == 1e+20] = -9999
-    tmp[tmp > 20] = 20
-    data0[:, :] = tmp[:, :]
-    del data0
-
-    data1 = np.memmap(os.path.join(outdir, "param/rivman.bin"), dtype=dtype_f,
-                      shape=(nlat, nlon), mode="r+")  # use carefully!
-    next1 = multiply_normalnoise(xa_each[2, :], 0.25, 0.5, 1.5)
-    tmp = dau.revert_map(next1.astype(dtype_f).reshape(1, nvec), vec2lat, vec2lon, nlat, nlon)[0]
-    tmp[tmp < 0.01] = 0.01
-    tmp[tmp == 1e+20] = -9999
-    tmp[tmp > 5] = 5
-    data1[:, :] = tmp[:, :]
-    del data1
-
-    data2 = np.memmap(os.path.join(outdir, "param/rivshp.bin"), dtype=dtype_f,
-                      shape=(nlat, nlon), mode="r+")  # use carefully!
-    next2 = multiply_normalnoise(xa_each[3, :], 0.25, 0.5, 1.5)
-    tmp = dau.revert_map(next2.astype(dtype_f).reshape(1, nvec), vec2lat, vec2lon, nlat, nlon)[0]
-    tmp[tmp < 1] = 1
-    tmp[tmp == 1e+20] = -9999
-    tmp[tmp > 20] = 20
-    data2[:, :] = tmp[:, :]
-    del data2
 #
@@ -0,0 +1,209 @@
+import os
+import glob
+import json
+import queue
+import datetime
+import threading
+import pytz
+import dautils as dau
+
+"""
+rotating checkpoint ring of ensemble restart states.
+
+A checkpoint is a snapshot of every member's restart.bin and param/*.bin
+together with the driver state (date, nT). Files are read into memory
+in the calling thread, so the snapshot is consistent with the end of
+the cycle, and written to disk by a background thread while the next
+forecast is running. A slot is only valid once its checkpoint.json
+marker is written, which is the last step of writing a slot.
+
+    ckptdir/slot00/checkpoint.json
+    ckptdir/slot00/{eNum:02d}/restart.bin
+    ckptdir/slot00/{eNum:02d}/param/*.bin
+"""
+
+MARKER = "checkpoint.json"
+DATEFMT = "%Y%m%d%H"
+
+
+def member_files(outdir):
+    """
+    returns files to be checkpointed in a member's output directory,
+    as paths relative to outdir.
+    """
+    files = ["restart.bin"]
+    params = glob.glob(os.path.join(outdir, "param", "*.bin"))
+    files.extend(sorted(os.path.join("param", os.path.basename(path))
+                        for path in params))
+    return files
+
+
+class CheckpointRing(object):
+    """
+    rotating ring of checkpoints written in background.
+
+    Args:
+        ckptdir (str): root directory of the ring
+        outdir (str): member output directory, formatted with eNum
+        eTot (int): total number of ensemble members
+        keep (int): number of slots in the ring
+        every (int): checkpoint every this number of cycles
+
+    Notes:
+        at most one snapshot is held in memory while the previous one is
+        being written; save() blocks until the writer is free. Call
+        close() to flush the last checkpoint.
+    """
+
+    def __init__(self, ckptdir, outdir, eTot, keep=2, every=1):
+        self.ckptdir = ckptdir
+        self.outdir = outdir
+        self.eTot = eTot
+        self.keep = max(1, int(keep))
+        self.every = max(1, int(every))
+        latest = self.latest()
+        self.count = 0 if latest is None else latest["count"] + 1
+        self.ncycle = 0
+        self._error = None
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._writer)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def slotdir(self, slot):
+        return os.path.join(self.ckptdir, "slot{0:02d}".format(slot))
+
+    def markers(self):
+        """
+        returns list of complete checkpoint information.
+        """
+        infos = []
+        for path in glob.glob(os.path.join(self.ckptdir, "slot*", MARKER)):
+            with open(path, "r") as f:
+                info = json.load(f)
+            info["slotdir"] = os.path.dirname(path)
+            infos.append(info)
+        return infos
+
+    def latest(self):
+        """
+        returns the newest complete checkpoint information (dict with
+        date, nT, count and slotdir), or None if there is no checkpoint.
+        """
+        infos = self.markers()
+        if len(infos) == 0:
+            return None
+        return max(infos, key=lambda info: info["count"])
+
+    def cycle(self, date, nT):
+        """
+        count one assimilation cycle, and checkpoint every N cycles.
+
+        Args:
+            date (datetime.datetime): next initial date of the driver
+            nT (int): number of time steps of the last cycle
+        """
+        self.ncycle += 1
+        if self.ncycle % self.every == 0:
+            self.save(date, nT)
+
+    def save(self, date, nT):
+        """
+        snapshot member files into memory and queue them for writing.
+
+        Args:
+            date (datetime.datetime): next initial date of the driver
+            nT (int): number of time steps of the last cycle
+        """
+        self._raise()
+        snapshot = []
+        for eNum in range(self.eTot):
+            outdir = self.outdir.format(eNum)
+            for relpath in member_files(outdir):
+                with open(os.path.join(outdir, relpath), "rb") as f:
+                    snapshot.append((eNum, relpath, f.read()))
+        info = {"date": date.strftime(DATEFMT), "nT": int(nT),
+                "count": self.count, "eTot": self.eTot}
+        self._queue.put((self.count % self.keep, info, snapshot))
+        self.count += 1
+
+    def _writer(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    break
+                if self._error is None:
+                    self._write(*task)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, slot, info, snapshot):
+        slotdir = self.slotdir(slot)
+        marker = os.path.join(slotdir, MARKER)
+        # invalidate the slot before overwriting
+        if os.path.exists(marker):
+            os.remove(marker)
+        for eNum, relpath, data in snapshot:
+            path = os.path.join(slotdir, "{0:02d}".format(eNum), relpath)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        tmppath = marker + ".tmp"
+        with open(tmppath, "w") as f:
+            json.dump(info, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmppath, marker)
+
+    def _raise(self):
+        if self._error is not None:
+            raise RuntimeError("checkpoint writer failed: {0}"
+                               .format(self._error))
+
+    def wait(self):
+        """
+        block until every queued checkpoint is written.
+        """
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        """
+        flush queued checkpoints and stop the writer.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
+
+    def restore(self, info=None):
+        """
+        copy checkpointed files back to member output directories.
+
+        Args:
+            info (dict): checkpoint information from latest().
+                         None to use the newest one.
+
+        Returns:
+            datetime.datetime: utc aware next initial date
+            int: number of time steps of the last cycle
+        """
+        if info is None:
+            info = self.latest()
+        if info is None:
+            raise IOError("no complete checkpoint in {0}"
+                          .format(self.ckptdir))
+        for eNum in range(self.eTot):
+            srcdir = os.path.join(info["slotdir"], "{0:02d}".format(eNum))
+            outdir = self.outdir.format(eNum)
+            for relpath in member_files(srcdir):
+                dau.stage_file(os.path.join(srcdir, relpath),
+                               os.path.join(outdir, relpath))
+        date = datetime.datetime.strptime(info["date"], DATEFMT)
+        return pytz.utc.localize(date), info["nT"]
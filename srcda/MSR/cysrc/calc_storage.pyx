@@ -7,12 +7,178 @@ ctypedef fused my_type:
     double
     float
 
+"""
+inversion of river/floodplain storage from flow width.
+
+The floodplain of a cell is discretized into nlfp layers of equal width
+increment wthinc = grarea/(rivlen*nlfp), each with the slope fldgrd.
+make_fldtable() accumulates the width and depth at each layer boundary
+once per map, so that get_storage_invertsely() solves each cell with a
+binary search over its table instead of walking the layers.
+get_storage_reference() is the serial layer-walking implementation,
+kept as the reference of the results.
+"""
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def make_fldtable(const my_type[:] rivwth, const my_type[:] rivlen,
+                  const my_type[:] grarea, const my_type[:, :] fldgrd,
+                  int nvec, int nlfp):
+    """
+    cumulative floodplain width and depth at each layer boundary.
+
+    Args:
+        rivwth (np.ndarray): river width [nvec]
+        rivlen (np.ndarray): river length [nvec]
+        grarea (np.ndarray): catchment area [nvec]
+        fldgrd (np.ndarray): floodplain gradient [nlfp, nvec]
+        nvec (int): length of whole vector
+        nlfp (int): number of floodplain layers
+
+    Returns:
+        np.ndarray: wthtab [nlfp, nvec]; width at the k-th boundary
+        np.ndarray: dphtab [nlfp, nvec]; depth at the k-th boundary
+
+    Notes:
+        accumulated in the same order and precision as the layer walk,
+        so that results are identical to get_storage_reference().
+    """
+    cdef int iv, k
+    cdef my_type wthinc
+    if my_type is double:
+        DTYPE = np.float64
+    elif my_type is float:
+        DTYPE = np.float32
+    wthtab = np.empty([nlfp, nvec], dtype=DTYPE)
+    dphtab = np.empty([nlfp, nvec], dtype=DTYPE)
+    cdef my_type[:, :] wthtab_view = wthtab
+    cdef my_type[:, :] dphtab_view = dphtab
+    for iv in prange(0, nvec, nogil=True):
+        wthinc = grarea[iv]/(rivlen[iv]*nlfp)
+        wthtab_view[0, iv] = rivwth[iv]
+        dphtab_view[0, iv] = 0
+        for k in range(1, nlfp):
+            wthtab_view[k, iv] = wthinc + wthtab_view[k-1, iv]
+            dphtab_view[k, iv] = fldgrd[k-1, iv]*wthinc + dphtab_view[k-1, iv]
+    return wthtab, dphtab
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def get_storage_invertsely(my_type[:] outwth, my_type[:] rivwth,
-                           my_type[:] rivlen, my_type[:] rivhgt,
-                           my_type[:] rivshp, my_type[:] grarea, my_type[:, :] fldgrd,
-                           int nvec, int nlfp, int undef):
+@cython.cdivision(True)
+cdef inline void invert_cell(my_type outwth, my_type rivwth, my_type rivlen,
+                             my_type rivhgt, my_type rivshp,
+                             const my_type[:, :] wthtab,
+                             const my_type[:, :] dphtab,
+                             const my_type[:, :] fldgrd, int iv, int nlfp,
+                             my_type[:, :] storage) noexcept nogil:
+    # every temporary is local to this call, thus thread-private.
+    cdef my_type s = rivshp
+    # s+1 is rounded to my_type as in get_storage_reference()
+    cdef my_type s1 = s + 1
+    cdef my_type wflw, hflw, wflp, hflp, Ariv, Aflp, Atmp
+    cdef int lo, hi, mid, layer
+    if outwth < rivwth:
+        # inbank
+        wflw = outwth
+        hflw = rivhgt*((wflw/rivwth)**s)
+        Ariv = wflw * hflw * (1-(1/s1))
+        Aflp = 0
+    else:
+        # outbank
+        wflw = rivwth
+        hflw = rivhgt
+        Ariv = wflw * hflw * (1-(1/s1))
+        wflp = outwth
+        # first boundary with width >= wflp, capped at the last layer
+        lo = 0
+        hi = nlfp-1
+        while lo < hi:
+            mid = (lo+hi)//2
+            if wthtab[mid, iv] < wflp:
+                lo = mid + 1
+            else:
+                hi = mid
+        layer = lo
+        if layer == 0:
+            # wflp == rivwth; no floodplain storage
+            hflp = 0
+        else:
+            hflp = dphtab[layer, iv] + \
+                   (wflp-wthtab[layer, iv])*fldgrd[layer-1, iv]
+        Atmp = (wflp + wflw) * hflp / 2.
+        Ariv = Ariv + wflw*hflp
+        Aflp = Atmp - wflw*hflp
+    storage[0, iv] = rivlen * Ariv
+    storage[1, iv] = rivlen * Aflp
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def get_storage_invertsely(const my_type[:] outwth,
+                           const my_type[:] rivwth,
+                           const my_type[:] rivlen,
+                           const my_type[:] rivhgt,
+                           const my_type[:] rivshp,
+                           const my_type[:] grarea,
+                           const my_type[:, :] fldgrd, int nvec, int nlfp,
+                           int undef, wthtab=None, dphtab=None):
+    """
+    river and floodplain storage from flow width.
+
+    Args:
+        outwth (np.ndarray): flow width [nvec]
+        rivwth (np.ndarray): river width [nvec]
+        rivlen (np.ndarray): river length [nvec]
+        rivhgt (np.ndarray): river height [nvec]
+        rivshp (np.ndarray): river shape parameter [nvec]
+        grarea (np.ndarray): catchment area [nvec]
+        fldgrd (np.ndarray): floodplain gradient [nlfp, nvec]
+        nvec (int): length of whole vector
+        nlfp (int): number of floodplain layers
+        undef (int): undefined value of rivhgt
+        wthtab, dphtab (np.ndarray): output of make_fldtable().
+                                     computed if None.
+
+    Returns:
+        np.ndarray: [rivsto, fldsto] [2, nvec]; 0 where undef
+    """
+    cdef int iv
+    if my_type is double:
+        DTYPE = np.float64
+    elif my_type is float:
+        DTYPE = np.float32
+    if wthtab is None or dphtab is None:
+        wthtab, dphtab = make_fldtable(rivwth, rivlen, grarea, fldgrd,
+                                       nvec, nlfp)
+    cdef const my_type[:, :] wthtab_view = wthtab
+    cdef const my_type[:, :] dphtab_view = dphtab
+    storage = np.zeros([2, nvec], dtype=DTYPE)
+    cdef my_type[:, :] storage_view = storage
+    for iv in prange(0, nvec, nogil=True):
+        if rivhgt[iv] == undef:
+            continue
+        invert_cell(outwth[iv], rivwth[iv], rivlen[iv], rivhgt[iv],
+                    rivshp[iv], wthtab_view, dphtab_view, fldgrd, iv, nlfp,
+                    storage_view)
+    return storage
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def get_storage_reference(const my_type[:] outwth,
+                          const my_type[:] rivwth,
+                          const my_type[:] rivlen,
+                          const my_type[:] rivhgt,
+                          const my_type[:] rivshp,
+                          const my_type[:] grarea,
+                          const my_type[:, :] fldgrd, int nvec, int nlfp,
+                          int undef):
+    """
+    serial layer-walking implementation of get_storage_invertsely().
+    slow; used to check the results.
+    """
     cdef int iv
     cdef my_type s
     cdef my_type wflw
@@ -33,8 +199,7 @@ def get_storage_invertsely(my_type[:] outwth, my_type[:] rivwth,
         DTYPE = np.float32
     storage = np.zeros([2, nvec], dtype=DTYPE)
     cdef my_type [:, :] storage_view = storage
-    for iv in prange(0, nvec, nogil=True):
-    #for iv in range(0, nvec):
+    for iv in range(0, nvec):
         if rivhgt[iv] == undef:
             continue
         if outwth[iv] < rivwth[iv]:
@@ -61,10 +226,8 @@ def get_storage_invertsely(my_type[:] outwth, my_type[:] rivwth,
                 layer  = 1 + layer
                 if layer == nlfp-1:
                     break
-            if layer == nlfp:
-                # flow is over cell, assimilation may not be good in this grid.
-                # leave it as it was or make it fldstomax.
-                continue
+            if layer == 0:
+                hflp = 0
             else:
                 hflp = dphpre + (wflp-wthpre)*fldgrd[layer-1, iv]
             Atmp = (wflp + wflw) * hflp / 2.
@@ -2,11 +2,17 @@ import numpy as np
 from cython.parallel import prange
 cimport cython
 cimport numpy as np
+cimport openmp
 
 ctypedef fused my_type:
     np.int32_t
     float
 
+ctypedef fused vec_type:
+    np.int32_t
+    np.float32_t
+    np.float64_t
+
 cdef np.int32_t undef_int = -9999
 cdef np.float32_t undef_float = 1e+20
 
@@ -140,17 +146,10 @@ def vectorize_map3d_int32(const np.int32_t [:, :, :] inputmap,
     """
     wrapper for 3d data (2d map with multiple layers)
     """
-    cdef int i
     cdef int nvar = inputmap.shape[0]
-    veclayer = np.zeros([nvec], dtype=np.int32)
-    cdef np.int32_t [:] veclayer_view = veclayer
     vec = np.zeros([nvar, nvec], dtype=np.int32)
-    cdef np.int32_t [:, :] vec_view = vec
-
-    for i in range(nvar):
-        veclayer_view = vectorize_map2d_int32(inputmap[i], map2vec, nvec)
-        vec_view[i, :] = veclayer_view
-
+    gather_layers(np.asarray(inputmap).reshape(nvar, -1),
+                  map2flat(map2vec, nvec), vec)
     return vec
 
 
@@ -161,18 +160,125 @@ def vectorize_map3d_float32(const np.float32_t [:, :, :] inputmap,
     """
     wrapper for 3d data (2d map with multiple layers)
     """
-    cdef int i
     cdef int nvar = inputmap.shape[0]
-    veclayer = np.zeros([nvec], dtype=np.float32)
-    cdef np.float32_t [:] veclayer_view = veclayer
     vec = np.zeros([nvar, nvec], dtype=np.float32)
-    cdef np.float32_t [:, :] vec_view = vec
+    gather_layers(np.asarray(inputmap).reshape(nvar, -1),
+                  map2flat(map2vec, nvec), vec)
+    return vec
 
-    for i in range(nvar):
-        veclayer_view = vectorize_map2d_float32(inputmap[i], map2vec, nvec)
-        vec_view[i, :] = veclayer_view
 
-    return vec
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def make_flatIndex(const np.int32_t[:] vec2lat,
+                   const np.int32_t[:] vec2lon, int nlon):
+    """
+    make vector to flattened 2d map index (ilat*nlon + ilon).
+    Compute once and reuse in gather_layers/scatter_layers.
+
+    Args:
+        vec2lat (np.ndarray): 1d-2d mapper for latitude
+        vec2lon (np.ndarray): 1d-2d mapper for longitude
+        nlon (int): number of longitudinal grid cells
+    Returns:
+        vec2flat (np.ndarray): [nvec], np.int64
+    """
+    cdef Py_ssize_t iv
+    cdef Py_ssize_t nvec = vec2lat.shape[0]
+    vec2flat = np.zeros([nvec], dtype=np.int64)
+    cdef np.int64_t [:] vec2flat_view = vec2flat
+    for iv in prange(nvec, nogil=True):
+        vec2flat_view[iv] = <np.int64_t>vec2lat[iv] * nlon + vec2lon[iv]
+    return vec2flat
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def map2flat(const np.int32_t[:, :] map2vec, int nvec):
+    """
+    make vector to flattened 2d map index from map2vec.
+    Same as make_flatIndex, for callers having only map2vec.
+
+    Args:
+        map2vec (np.ndarray): output of make_vectorizeIndex()
+        nvec (int): number of total vector ids
+    Returns:
+        vec2flat (np.ndarray): [nvec], np.int64
+    """
+    cdef int nlat = map2vec.shape[0]
+    cdef int nlon = map2vec.shape[1]
+    cdef int ilat
+    cdef int ilon
+    cdef int ivec
+    vec2flat = np.zeros([nvec], dtype=np.int64)
+    cdef np.int64_t [:] vec2flat_view = vec2flat
+    for ilat in prange(nlat, nogil=True):
+        for ilon in range(nlon):
+            ivec = map2vec[ilat, ilon]
+            if ivec < 0:
+                continue
+            vec2flat_view[ivec] = <np.int64_t>ilat * nlon + ilon
+    return vec2flat
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def gather_layers(const vec_type[:, :] inputmap,
+                  const np.int64_t[:] vec2flat,
+                  vec_type[:, :] outvector):
+    """
+    vectorize all layers of a flattened 2d map in one parallel pass.
+
+    Args:
+        inputmap (np.ndarray): [nlayers, nlat*nlon], np.int32, np.float32
+                               or np.float64. a reshaped memmap works
+                               without copy.
+        vec2flat (np.ndarray): output of make_flatIndex()
+        outvector (np.ndarray): [nlayers, nvec], same dtype as inputmap.
+                                caller-supplied output buffer.
+    Returns:
+        None
+    """
+    cdef Py_ssize_t nlayer = inputmap.shape[0]
+    cdef Py_ssize_t nvec = vec2flat.shape[0]
+    cdef Py_ssize_t i
+    cdef Py_ssize_t il
+    cdef Py_ssize_t iv
+    for i in prange(nlayer*nvec, nogil=True):
+        il = i / nvec
+        iv = i - il*nvec
+        outvector[il, iv] = inputmap[il, vec2flat[iv]]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def scatter_layers(const vec_type[:, :] inputvector,
+                   const np.int64_t[:] vec2flat,
+                   vec_type[:, :] outmap):
+    """
+    revert all layers of vectors to a flattened 2d map in one parallel pass.
+    Cells not in vectors are left untouched.
+
+    Args:
+        inputvector (np.ndarray): [nlayers, nvec], np.int32, np.float32
+                                  or np.float64.
+        vec2flat (np.ndarray): output of make_flatIndex()
+        outmap (np.ndarray): [nlayers, nlat*nlon], same dtype as
+                             inputvector. caller-provided target;
+                             a reshaped memmap works without copy.
+    Returns:
+        None
+    """
+    cdef Py_ssize_t nlayer = inputvector.shape[0]
+    cdef Py_ssize_t nvec = vec2flat.shape[0]
+    cdef Py_ssize_t i
+    cdef Py_ssize_t il
+    cdef Py_ssize_t iv
+    for i in prange(nlayer*nvec, nogil=True):
+        il = i / nvec
+        iv = i - il*nvec
+        outmap[il, vec2flat[iv]] = inputvector[il, iv]
 
 
 @cython.boundscheck(False)
@@ -209,18 +315,11 @@ def revert_layers_grid_int32(const np.int32_t[:, :] inputvector,
     """
     wrapper to handle 1d vector with multiple layers
     """
-    cdef int il
-    cdef int nvec = len(vec2lat)
     cdef int nlayer = inputvector.shape[0]
-    layer = np.ones([nlat, nlon], dtype=np.int32)*undef_int
-    cdef np.int32_t [:, :] layer_view = layer
-    mapgrid = np.ones([nlayer, nlat, nlon], dtype=np.int32)*undef_int
-    cdef np.int32_t [:, :, :] mapgrid_view = mapgrid
-
-    for il in range(nlayer):
-        layer_view = revert_grid_int32(inputvector[il], vec2lat, vec2lon,
-                                       nlat, nlon)
-        mapgrid_view[il] = layer_view
+    mapgrid = np.full([nlayer, nlat, nlon], undef_int, dtype=np.int32)
+    scatter_layers(np.asarray(inputvector),
+                   make_flatIndex(vec2lat, vec2lon, nlon),
+                   mapgrid.reshape(nlayer, nlat*nlon))
     return mapgrid
 
 
@@ -258,17 +357,20 @@ def revert_layers_grid_float32(const np.float32_t[:, :] inputvector,
     """
     wrapper to handle 1d vector with multiple layers
     """
-    cdef int il
-    cdef int nvec = vec2lat.shape[0]
     cdef int nlayer = inputvector.shape[0]
+    mapgrid = np.full([nlayer, nlat, nlon], undef_float, dtype=np.float32)
+    scatter_layers(np.asarray(inputvector),
+                   make_flatIndex(vec2lat, vec2lon, nlon),
+                   mapgrid.reshape(nlayer, nlat*nlon))
+    return mapgrid
 
-    layer = np.ones([nlat, nlon], dtype=np.float32)*undef_float
-    cdef np.float32_t [:, :] layer_view = layer
-    mapgrid = np.ones([nlayer, nlat, nlon], dtype=np.float32)*undef_float
-    cdef np.float32_t [:, :, :] mapgrid_view = mapgrid
 
-    for il in range(nlayer):
-        layer_view = revert_grid_float32(inputvector[il], vec2lat, vec2lon,
-                                         nlat, nlon)
-        mapgrid_view[il] = layer_view
-    return mapgrid
+def set_num_threads(int nthreads):
+    """
+    set the number of OpenMP threads of parallel loops in this process.
+    the OpenMP runtime is shared by camavec and calc_storage.
+
+    Args:
+        nthreads (int): number of threads
+    """
+    openmp.omp_set_num_threads(nthreads)
@@ -1,6 +1,13 @@
+import os
+import errno
+import shutil
 import numpy as np
 import h5py
 import camavec
+try:
+    import fcntl
+except ImportError:  # not on posix
+    fcntl = None
 
 """
 sets of functions frequently used in the pyletkf context.
@@ -9,7 +16,7 @@ may be included in pyletkf package in future release.
 
 
 def load_data3d(dpath, nt, nlat, nlon, map2vec, nvec,
-                dtype=np.float32, memmap=True):
+                dtype=np.float32, memmap=True, vec2flat=None, out=None):
     """
     load binary datasets from dpath [nt, nlat, nlon]
 
@@ -20,6 +27,9 @@ def load_data3d(dpath, nt, nlat, nlon, map2vec, nvec,
         memmap (bool): True to use np.memmap backend to load data.
             provides efficient IO with ignorable perfomace loss.
             effective for large datasets.
+        vec2flat (np.ndarray): precomputed output of make_flatIndex().
+                               computed from map2vec if None.
+        out (np.ndarray): [nt, nvec] output buffer. allocated if None.
     Returns:
         numpy array-like object: [nt, nlat*nlon]
                                     1d vectorized map for nt layers.
@@ -44,10 +54,105 @@ def load_data3d(dpath, nt, nlat, nlon, map2vec, nvec,
         # this will benefit slight performance gain for array manipulation
         # but takes time if your data is large to load on.
         data = np.fromfile(dpath, dtype=dtype).reshape(nt, nlat, nlon)
-    vecdata = vectorize_map(data, map2vec, nvec)
+    vecdata = vectorize_map(data, map2vec, nvec, vec2flat=vec2flat, out=out)
     return vecdata
 
 
+def load_record(dpath, irec, nlat, nlon, map2vec, nvec, dtype=np.float32,
+                vec2flat=None, out=None):
+    """
+    load a single record (REC=irec+1 in Fortran) from binary dataset
+    at dpath [nt, nlat, nlon] without touching other records.
+
+    Args:
+        dpath (str): path to data
+        irec (int): 0-based record number; e.g., nt-1 for the last record
+        dtype (np object): dtype, default 4byte real
+        vec2flat (np.ndarray): see load_data3d()
+        out (np.ndarray): see load_data3d()
+    Returns:
+        numpy array-like object: [1, nlat*nlon]
+                                    1d vectorized map for the record.
+    Notes:
+        the record is read through an offset memmap, thus I/O is
+        1/nt of load_data3d(). Make sure irec < nt, otherwise
+        memmap throws error.
+    """
+    offset = irec * nlat * nlon * np.dtype(dtype).itemsize
+    data = np.memmap(dpath, dtype=dtype, mode="r", offset=offset,
+                     shape=(1, nlat, nlon), order="C")
+    vecdata = vectorize_map(data, map2vec, nvec, vec2flat=vec2flat, out=out)
+    return vecdata
+
+
+FICLONE = 0x40049409  # linux ioctl to clone (reflink) a file
+READONLY = 0o444  # file mode of files shared by stage_file(share=True)
+
+
+def stage_file(src, dst, share=False):
+    """
+    stage a map/parameter file at dst without spawning cp.
+
+    Args:
+        src (str): source file path
+        dst (str): destination file path; overwritten if exists.
+        share (bool): True for files never written afterwards (e.g.,
+                      init/ backups); dst shares the data blocks of src
+                      if reflink is supported, and is made read-only
+                      (0o444). src is never modified, as it may not be
+                      owned by the DA run (e.g., maps).
+
+    Returns:
+        str: method used; "reflink", "copy_file_range" or "copyfile"
+
+    Notes:
+        dst is removed first, thus a staged copy never writes through an
+        inode shared with other members.
+        Independent copies are tried in order of cost:
+        reflink (copy-on-write; btrfs, xfs) -> os.copy_file_range
+        (in-kernel copy) -> shutil.copyfile.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    method = copy_file(src, dst)
+    if share:
+        # dst is its own inode; a hard link would make src read-only too.
+        os.chmod(dst, READONLY)
+    return method
+
+
+def copy_file(src, dst):
+    """
+    copy src to a new file dst in the cheapest way available.
+    see stage_file().
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return "reflink"
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                size = os.fstat(fsrc.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                           size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                if copied == size:
+                    return "copy_file_range"
+            except OSError as e:
+                if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP, errno.EPERM]:
+                    raise
+    shutil.copyfile(src, dst)
+    return "copyfile"
+
+
 def define_state_vector(keys, datapaths):
     """
     Define what will be included as a state vector
@@ -172,7 +277,23 @@ def getvecid(ilat, ilon, map2vec):
     return map2vec[ilat, ilon]
 
 
-def vectorize_map(map3d, map2vec, nvec):
+def make_flatIndex(vec2lat, vec2lon, nlon):
+    """
+    Returns vector to flattened 2d map index (ilat*nlon + ilon).
+    Compute once per run and pass it to vectorize_map()/load_data3d().
+
+    Args:
+        vec2lat (np.ndarray): 1d-2d mapper for latitude
+        vec2lon (np.ndarray): 1d-2d mapper for longitude
+        nlon (int): number of longitudinal grid cells
+
+    Returns:
+        ndarray: [nvec] np.int64
+    """
+    return camavec.make_flatIndex(vec2lat, vec2lon, nlon)
+
+
+def vectorize_map(map3d, map2vec, nvec, vec2flat=None, out=None):
     """
     Returns vectorized 2dmap
 
@@ -180,15 +301,26 @@ def vectorize_map(map3d, map2vec, nvec):
         map3d (np.ndarray): input 2d map with layers [nlayers, nlat, nlon]
         map2vec (np.ndarray): 2d-1d mapper
         nvec (int): length of whole vector (len(vec2lat))
+        vec2flat (np.ndarray): output of make_flatIndex().
+                               computed from map2vec if None.
+        out (np.ndarray): [nlayers, nvec] output buffer with the same
+                          dtype as map3d. allocated if None.
+
+    Notes:
+        All layers are gathered in one parallel pass
+        (camavec.gather_layers). map3d is reshaped to
+        [nlayers, nlat*nlon], which is a view for memmaps.
     """
     DTYPE = map3d.dtype
-    if DTYPE == np.float32:
-        outvector = camavec.vectorize_map3d_float32(map3d, map2vec, nvec)
-    elif DTYPE == np.int32:
-        outvector = camavec.vectorize_map3d_int32(map3d, map2vec, nvec)
-    else:
-        TypeError("type {0} is not supported".format(DTYPE))
-    return outvector
+    if DTYPE not in [np.float32, np.float64, np.int32]:
+        raise TypeError("type {0} is not supported".format(DTYPE))
+    if vec2flat is None:
+        vec2flat = camavec.map2flat(map2vec, nvec)
+    nlayer = map3d.shape[0]
+    if out is None:
+        out = np.empty([nlayer, nvec], dtype=DTYPE)
+    camavec.gather_layers(map3d.reshape(nlayer, -1), vec2flat, out)
+    return out
 
 
 def revert_map(vec2d, vec2lat, vec2lon, nlat, nlon):
@@ -216,3 +348,37 @@ def revert_map(vec2d, vec2lat, vec2lon, nlat, nlon):
     else:
         TypeError("type {0} is not supported".format(DTYPE))
     return outmap
+
+
+def revert_map_into(vec2d, vec2flat, target, fill=None):
+    """
+    revert 1d vector with layers (2d) into a caller-provided
+    2d map with layers (3d) in one parallel pass.
+
+    Args:
+        vec2d (np.ndarray): vectorized 1d array with layers
+                            [nlayers, nvec]
+        vec2flat (np.ndarray): output of make_flatIndex()
+        target (np.ndarray-like): C-contiguous [nlayers, nlat, nlon];
+                                  e.g., np.memmap opened with r+/w+.
+        fill (scalar): value for cells not in vectors. If None, those
+                       cells are left as they are in target.
+
+    Returns:
+        np.ndarray-like: target
+
+    Notes:
+        vec2d is casted to target.dtype if needed; this is the only
+        temporary and it is vector sized.
+    """
+    if not target.flags.c_contiguous:
+        raise ValueError("target must be C-contiguous.")
+    DTYPE = target.dtype
+    if DTYPE not in [np.float32, np.float64, np.int32]:
+        raise TypeError("type {0} is not supported".format(DTYPE))
+    nlayer = target.shape[0]
+    if fill is not None:
+        target[...] = fill
+    camavec.scatter_layers(vec2d.astype(DTYPE, copy=False).reshape(nlayer, -1),
+                           vec2flat, target.reshape(nlayer, -1))
+    return target
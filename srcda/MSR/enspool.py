@@ -0,0 +1,255 @@
+import os
+import queue
+import traceback
+import multiprocessing as mp
+import threadbudget
+
+"""
+persistent, ensemble-aware worker pool used by AssimCama.
+
+A pool is created by AssimCama.open() (called from register(), and
+again after close()) and reused by every phase of every assimilation
+cycle (spinup, forwarding, postprocessing).
+Each worker owns a fixed subset of ensemble members; a task submitted
+for member eNum is always executed by the worker that owns eNum, so
+member-specific state (open files, caches) stays in one process.
+Workers are forked only once; resize() changes the number of workers
+in use, their core sets and OpenMP threads in place.
+"""
+
+
+def _configure(cpuset, nthreads):
+    """
+    pin this process to cpuset and limit its OpenMP threads to nthreads.
+    None (or empty cpuset) to leave as is.
+    """
+    if cpuset and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpuset)
+    if nthreads is not None:
+        threadbudget.limit_threads(nthreads)
+
+
+def _worker_loop(wid, members, inq, outq, cpuset=None, nthreads=None):
+    """
+    main loop of a worker process. Executes (func, args) tasks from inq
+    until None is received, and puts (taskid, ok, result) into outq.
+    A task with func None reconfigures the worker (see
+    EnsemblePool.resize()); args are (members, cpuset, nthreads).
+
+    Args:
+        wid (int): worker id
+        members (list): ensemble members owned by this worker
+        inq (multiprocessing.Queue): task queue of this worker
+        outq (multiprocessing.Queue): result queue shared by workers
+        cpuset (list): cores to pin this worker (and its child
+                       processes) to. None or empty not to pin.
+        nthreads (int): OpenMP threads of this worker.
+                        None not to limit.
+    """
+    _configure(cpuset, nthreads)
+    while True:
+        task = inq.get()
+        if task is None:
+            break
+        taskid, func, args = task
+        try:
+            if func is None:
+                members = args[0]
+                result = _configure(args[1], args[2])
+            else:
+                result = func(args)
+            outq.put((taskid, True, result))
+        except Exception:
+            outq.put((taskid, False,
+                      "worker {0} (members {1}) failed:\n{2}"
+                      .format(wid, members, traceback.format_exc())))
+
+
+class EnsemblePool(object):
+    """
+    long-lived worker pool with members pinned to workers.
+
+    Args:
+        nprocs (int): number of worker processes
+        eTot (int): total number of ensemble members
+        cpusets (list): core set for each worker (see threadbudget.py).
+                        None not to pin workers.
+        nthreads (int): OpenMP threads of each worker. None not to limit.
+        nworkers (int): number of worker processes to fork; at least
+                        nprocs. Workers beyond nprocs stay idle until
+                        resize(). None for nprocs.
+
+    Notes:
+        Members are distributed round-robin; worker w owns
+        [w, w+nprocs, w+2*nprocs, ...]. func passed to map() must be
+        picklable (module-level function), the same as multiprocessing.Pool.
+        Call close() (or use as a context manager) to shut down workers.
+    """
+
+    def __init__(self, nprocs, eTot, cpusets=None, nthreads=None,
+                 nworkers=None):
+        self.eTot = int(eTot)
+        if nworkers is None:
+            nworkers = nprocs
+        nworkers = max(1, min(max(int(nworkers), int(nprocs)), self.eTot))
+        self.nprocs = max(1, min(int(nprocs), nworkers))
+        self.members = self.distribute(nworkers)
+        self.outq = mp.Queue()
+        self.inqs = []
+        self.procs = []
+        for wid in range(nworkers):
+            inq = mp.Queue()
+            cpuset = None
+            if cpusets is not None and wid < self.nprocs:
+                cpuset = cpusets[wid]
+            proc = mp.Process(target=_worker_loop,
+                              args=(wid, self.members[wid], inq, self.outq,
+                                    cpuset, nthreads))
+            proc.daemon = True
+            proc.start()
+            self.inqs.append(inq)
+            self.procs.append(proc)
+        self._taskid = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def distribute(self, nworkers):
+        """
+        returns members of each of nworkers workers; only the first
+        self.nprocs workers own members.
+        """
+        return [list(range(w, self.eTot, self.nprocs))
+                if w < self.nprocs else []
+                for w in range(nworkers)]
+
+    def owner(self, eNum):
+        """
+        returns worker id owning ensemble member eNum.
+        """
+        return eNum % self.nprocs
+
+    def submit(self, func, args, eNum):
+        """
+        submit one task for member eNum. Returns task id.
+        """
+        if self.closed:
+            raise RuntimeError("pool is already closed.")
+        taskid = self._taskid
+        self._taskid += 1
+        self.inqs[self.owner(eNum)].put((taskid, func, args))
+        return taskid
+
+    def resize(self, nprocs, cpusets=None, nthreads=None):
+        """
+        use nprocs workers with new core sets and OpenMP threads,
+        without forking new processes. Members are re-distributed
+        round-robin over the first nprocs workers.
+
+        Args:
+            nprocs (int): number of workers to use; at most the number
+                          of forked workers.
+            cpusets (list): core set for each worker in use.
+                            None not to re-pin workers.
+            nthreads (int): OpenMP threads of each worker.
+                            None not to limit.
+        """
+        if self.closed:
+            raise RuntimeError("pool is already closed.")
+        nworkers = len(self.procs)
+        self.nprocs = max(1, min(int(nprocs), nworkers))
+        self.members = self.distribute(nworkers)
+        remaining = set()
+        for wid in range(nworkers):
+            cpuset = None
+            if cpusets is not None and wid < self.nprocs:
+                cpuset = cpusets[wid]
+            taskid = self._taskid
+            self._taskid += 1
+            self.inqs[wid].put((taskid, None,
+                                (self.members[wid], cpuset, nthreads)))
+            remaining.add(taskid)
+        errors = []
+        while len(remaining) > 0:
+            taskid, ok, result = self._get()
+            if taskid not in remaining:
+                continue
+            remaining.remove(taskid)
+            if not ok:
+                errors.append(result)
+        if len(errors) > 0:
+            raise RuntimeError("\n".join(errors))
+
+    def _get(self):
+        """
+        get one result from workers, checking workers are alive.
+        """
+        while True:
+            try:
+                return self.outq.get(timeout=5)
+            except queue.Empty:
+                dead = [p.pid for p in self.procs if not p.is_alive()]
+                if len(dead) > 0:
+                    raise RuntimeError("worker process(es) {0} died."
+                                       .format(dead))
+
+    def imap_unordered(self, func, argslist, members=None):
+        """
+        execute func(args) for each args in argslist on the owner of
+        the corresponding member, and yield (eNum, result) in the order
+        of completion.
+
+        Args:
+            func (function): picklable function taking one argument
+            argslist (list): arguments, one for each member
+            members (list): ensemble member id of each args.
+                            default is range(len(argslist)).
+        """
+        if members is None:
+            members = list(range(len(argslist)))
+        task2member = {}
+        for args, eNum in zip(argslist, members):
+            task2member[self.submit(func, args, eNum)] = eNum
+        remaining = set(task2member.keys())
+        errors = []
+        while len(remaining) > 0:
+            taskid, ok, result = self._get()
+            if taskid not in remaining:
+                # left over from an abandoned iteration
+                continue
+            remaining.remove(taskid)
+            if not ok:
+                errors.append(result)
+                continue
+            if len(errors) == 0:
+                yield task2member[taskid], result
+        if len(errors) > 0:
+            raise RuntimeError("\n".join(errors))
+
+    def map(self, func, argslist, members=None):
+        """
+        blocking version of imap_unordered. Returns results ordered as
+        argslist.
+        """
+        if members is None:
+            members = list(range(len(argslist)))
+        results = dict(self.imap_unordered(func, argslist, members=members))
+        return [results[eNum] for eNum in members]
+
+    def close(self):
+        """
+        shut down workers and wait for them to exit.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for inq in self.inqs:
+            inq.put(None)
+        for proc in self.procs:
+            proc.join()
+        for q in self.inqs + [self.outq]:
+            q.close()
@@ -0,0 +1,169 @@
+import numpy as np
+import h5py
+from obsstore import to_datetime64
+
+"""
+streaming ensemble statistics for forecast and analysis diagnostics.
+
+EnsembleStats accumulates the ensemble mean and spread in vector space
+with Welford's algorithm, one member at a time, so that a state vector
+on disk (statebuffer="disk") is never loaded at once. StatsStore keeps
+per-cycle statistics in one compressed HDF5 file:
+
+    /time               [ncycle] analysis date, datetime64[ns] as int64
+    /forecast/mean      [ncycle, nvars, nvec]
+    /forecast/spread    [ncycle, nvars, nvec]
+    /analysis/mean      [ncycle, nvars, nvec]
+    /analysis/spread    [ncycle, nvars, nvec]
+    /omf                [ncycle, nobsvars, nvec] observation - forecast
+    /oma                [ncycle, nobsvars, nvec] observation - analysis
+
+Statistics are in the transformed space of the state vector
+(e.g., log for statedist="log"); undef where not observed. Analysis
+statistics are of the LETKF output, before inflation.
+"""
+
+
+class EnsembleStats(object):
+    """
+    Welford accumulator of ensemble mean and spread.
+
+    Args:
+        shape (tuple): shape of one member, e.g., (nvars, nvec)
+    """
+
+    def __init__(self, shape):
+        self.count = 0
+        self._mean = np.zeros(shape, dtype=np.float64)
+        self._m2 = np.zeros(shape, dtype=np.float64)
+        self._delta = np.empty(shape, dtype=np.float64)
+
+    def update(self, x):
+        """
+        add one member.
+
+        Args:
+            x (np.ndarray): member state, same shape as the accumulator
+        """
+        self.count += 1
+        np.subtract(x, self._mean, out=self._delta)
+        self._mean += self._delta/self.count
+        # m2 += (x - old mean)*(x - new mean)
+        self._m2 += self._delta*(x - self._mean)
+
+    @classmethod
+    def from_ensemble(cls, ensemble, axis=1):
+        """
+        accumulate over the member axis of an ensemble array.
+
+        Args:
+            ensemble (np.ndarray-like): e.g., [nvars, eTot, nvec]
+            axis (int): member axis
+
+        Returns:
+            EnsembleStats
+        """
+        shape = ensemble.shape[:axis] + ensemble.shape[axis+1:]
+        stats = cls(shape)
+        for eNum in range(ensemble.shape[axis]):
+            stats.update(np.take(ensemble, eNum, axis=axis))
+        return stats
+
+    def mean(self):
+        return self._mean
+
+    def spread(self):
+        """
+        returns ensemble standard deviation (ddof=1).
+        """
+        if self.count < 2:
+            return np.zeros_like(self._m2)
+        return np.sqrt(self._m2/(self.count-1))
+
+
+def innovation(obs, mean, obsidx, undef):
+    """
+    returns observation minus ensemble mean of observed variables.
+
+    Args:
+        obs (np.ndarray): observations [nobsvars, nvec]; undef if none
+        mean (np.ndarray): ensemble mean [nvars, nvec]
+        obsidx (list): index in state variables of each observation
+        undef (float): undefined value
+
+    Returns:
+        np.ndarray: [nobsvars, nvec]; undef if not observed
+    """
+    omx = obs - mean[obsidx]
+    omx[obs == undef] = undef
+    return omx
+
+
+class StatsStore(object):
+    """
+    appender of per-cycle ensemble statistics.
+
+    Args:
+        path (str): path to HDF5 file; appended if exists
+        nvars (int): number of state variables
+        nobsvars (int): number of observation variables
+        nvec (int): length of whole vector
+        undef (float): undefined value
+    """
+
+    fields = [("forecast/mean", "nvars"), ("forecast/spread", "nvars"),
+              ("analysis/mean", "nvars"), ("analysis/spread", "nvars"),
+              ("omf", "nobsvars"), ("oma", "nobsvars")]
+
+    def __init__(self, path, nvars, nobsvars, nvec, undef):
+        self.path = path
+        self.f = h5py.File(path, "a")
+        if "time" not in self.f:
+            self.f.create_dataset("time", shape=(0,), maxshape=(None,),
+                                  dtype=np.int64, chunks=(1024,))
+            self.f["time"].attrs["units"] = "ns since 1970-01-01 (utc)"
+        nlayer = {"nvars": nvars, "nobsvars": nobsvars}
+        for field, dim in self.fields:
+            if field in self.f:
+                continue
+            self.f.create_dataset(field, shape=(0, nlayer[dim], nvec),
+                                  maxshape=(None, nlayer[dim], nvec),
+                                  dtype=np.float32,
+                                  chunks=(1, nlayer[dim], nvec),
+                                  compression="gzip", shuffle=True,
+                                  fillvalue=undef)
+
+    def append(self, date, **data):
+        """
+        append statistics of one cycle.
+
+        Args:
+            date (datetime.datetime): analysis date
+            **data: arrays keyed by field name with "/" replaced by "_",
+                    e.g., forecast_mean=..., omf=...
+        """
+        nc = self.f["time"].shape[0]
+        self.f["time"].resize((nc+1,))
+        self.f["time"][nc] = to_datetime64(date).astype(np.int64)
+        for field, _ in self.fields:
+            dset = self.f[field]
+            dset.resize(nc+1, axis=0)
+            dset[nc] = data[field.replace("/", "_")]
+        self.f.flush()
+
+    def truncate(self, date):
+        """
+        drop cycles at or after date (e.g., when restarting).
+        """
+        times = self.f["time"][:]
+        nc = int(np.searchsorted(times, to_datetime64(date).astype(np.int64),
+                                 side="left"))
+        if nc == len(times):
+            return
+        self.f["time"].resize((nc,))
+        for field, _ in self.fields:
+            self.f[field].resize(nc, axis=0)
+
+    def close(self):
+        if self.f:
+            self.f.close()
@@ -0,0 +1,267 @@
+import numpy as np
+from obsstore import to_datetime64
+
+"""
+covariance inflation and parameter noise applied to the analysis.
+
+Every method works on the last step of the analysis, [eTot, nvec] per
+variable, in the transformed space of the state vector (e.g., log for
+statedist="log"), and is vectorized over members and river cells:
+
+    multiplicative  x' = mean + rho*(x - mean)
+    additive        x' = x + sigma*z
+    rtps            x' = mean + (x - mean)*(1 + alpha*(sf - sa)/sa)
+                    relaxation to prior spread; sf, sa are forecast
+                    and analysis spread of each vecid.
+
+rho, sigma and alpha are scalars, or lists with one value per width
+class. Parameter noise multiplies parameters by clip(1 + std*z, minv,
+maxv), and is written to parameter files only; initial conditions are
+computed from the analysis before noise.
+
+z are drawn in the driver process from a counter-based generator
+(Philox) keyed on the seed; the stream of each cycle is jumped by the
+analysis hour, so results do not depend on the number of workers nor
+on restarts. z are drawn per "member" (one value shared by every cell),
+per width "class", or per "vecid".
+"""
+
+METHODS = ["none", "multiplicative", "additive", "rtps"]
+UNITS = ["member", "class", "vecid"]
+
+
+def cycle_rng(seed, date):
+    """
+    returns random number generator of a cycle.
+
+    Args:
+        seed (int): key of the generator; None for os entropy
+        date (datetime.datetime): analysis date
+
+    Returns:
+        numpy.random.Generator
+    """
+    hours = int(to_datetime64(date).astype("datetime64[h]").astype(np.int64))
+    return np.random.Generator(np.random.Philox(key=seed).jumped(hours))
+
+
+def draw_normal(rng, eTot, nvec, unit="vecid", classid=None):
+    """
+    standard normal draws broadcastable to [eTot, nvec].
+
+    Args:
+        rng (numpy.random.Generator): random number generator
+        eTot (int): total number of ensemble members
+        nvec (int): length of whole vector
+        unit (str): "member", "class" or "vecid"
+        classid (np.ndarray): width class of each vecid; needed if
+                              unit is "class"
+
+    Returns:
+        np.ndarray: [eTot, 1] for "member", [eTot, nvec] otherwise
+    """
+    if unit == "member":
+        return rng.standard_normal((eTot, 1))
+    elif unit == "class":
+        return rng.standard_normal((eTot, classid.max()+1))[:, classid]
+    elif unit == "vecid":
+        return rng.standard_normal((eTot, nvec))
+    raise KeyError("undefined unit: {0}".format(unit))
+
+
+def expand_factor(factor, classid=None):
+    """
+    returns factor broadcastable to [eTot, nvec].
+
+    Args:
+        factor (float or list): scalar, or a value per width class
+        classid (np.ndarray): width class of each vecid
+
+    Returns:
+        float or np.ndarray [nvec]
+    """
+    if np.ndim(factor) == 0:
+        return float(factor)
+    if classid is None:
+        raise ValueError("factor per width class needs classid.")
+    return np.asarray(factor, dtype=np.float64)[classid]
+
+
+def multiplicative(x, rho):
+    """
+    multiplicative inflation in place.
+
+    Args:
+        x (np.ndarray): ensemble [eTot, nvec]
+        rho (float or np.ndarray): inflation factor
+    """
+    mean = x.mean(axis=0)
+    x -= mean
+    x *= rho
+    x += mean
+
+
+def additive(x, sigma, z):
+    """
+    additive inflation in place.
+
+    Args:
+        x (np.ndarray): ensemble [eTot, nvec]
+        sigma (float or np.ndarray): standard deviation of perturbation
+        z (np.ndarray): output of draw_normal()
+    """
+    x += sigma*z
+
+
+def rtps(x, fspread, alpha):
+    """
+    relaxation to prior spread in place.
+
+    Args:
+        x (np.ndarray): ensemble [eTot, nvec]
+        fspread (np.ndarray): forecast spread [nvec] (ddof=1)
+        alpha (float or np.ndarray): relaxation factor; 0 for none,
+                                     1 to recover the forecast spread
+
+    Notes:
+        cells without analysis spread are left unchanged.
+    """
+    mean = x.mean(axis=0)
+    aspread = x.std(axis=0, ddof=1)
+    valid = aspread > 0
+    ratio = 1 + alpha*(fspread - aspread)/np.where(valid, aspread, 1)
+    ratio[~valid] = 1
+    x -= mean
+    x *= ratio
+    x += mean
+
+
+def multiply_noise(x, std, minv, maxv, z, dist="log"):
+    """
+    returns x multiplied by noise clip(1 + std*z, minv, maxv).
+
+    Args:
+        x (np.ndarray): ensemble [eTot, nvec] in transformed space
+        std (float or np.ndarray): standard deviation of noise
+        minv (float): lower bound of noise
+        maxv (float): upper bound of noise
+        z (np.ndarray): output of draw_normal()
+        dist (str): "log" or "norm"; distribution of x
+
+    Returns:
+        np.ndarray: [eTot, nvec] in transformed space
+    """
+    noise = np.clip(1 + std*z, minv, maxv)
+    if dist == "log":
+        return x + np.log(noise)
+    elif dist == "norm":
+        return x*noise
+    raise KeyError("undefined distribution: {0}".format(dist))
+
+
+class Inflation(object):
+    """
+    inflation and parameter noise of the analysis.
+
+    Args:
+        method (str): one of METHODS
+        factor (float or list): rho, sigma or alpha of the method;
+                                a list has a value per width class.
+        varidx (list): index in state variables to inflate
+        statedist (list): distribution of each state variable
+        seed (int): key of the generator; None for os entropy
+        unit (str): unit of additive perturbation (one of UNITS)
+        noisestd (float or list): standard deviation of parameter noise;
+                                  0 for none.
+        noiseidx (list): index in state variables to add noise
+        noiseunit (str): unit of parameter noise (one of UNITS)
+        noisebounds (tuple): lower and upper bound of noise
+        classid (np.ndarray): width class of each vecid; needed for
+                              "class" units or factors per class.
+    """
+
+    def __init__(self, method, factor, varidx, statedist, seed=None,
+                 unit="vecid", noisestd=0, noiseidx=None, noiseunit="member",
+                 noisebounds=(0.5, 1.5), classid=None):
+        if method not in METHODS:
+            raise KeyError("undefined inflation: {0}".format(method))
+        for u in [unit, noiseunit]:
+            if u not in UNITS:
+                raise KeyError("undefined unit: {0}".format(u))
+        self.method = method
+        self.varidx = varidx
+        self.statedist = statedist
+        self.seed = seed
+        self.unit = unit
+        self.noiseidx = [] if noiseidx is None else noiseidx
+        self.noiseunit = noiseunit
+        self.noisebounds = noisebounds
+        self.classid = classid
+        self.factor = expand_factor(factor, classid)
+        self.noisestd = expand_factor(noisestd, classid)
+
+    @property
+    def needs_prior(self):
+        """
+        True if the forecast spread is needed by apply().
+        """
+        return self.method == "rtps"
+
+    @property
+    def has_noise(self):
+        return len(self.noiseidx) > 0 and np.any(self.noisestd != 0)
+
+    def apply(self, date, xa, fspread=None, rng=None):
+        """
+        inflate the analysis in place.
+
+        Args:
+            date (datetime.datetime): analysis date
+            xa (np.ndarray): analysis [nvars, eTot, nvec]
+            fspread (np.ndarray): forecast spread [nvars, nvec];
+                                  needed for "rtps"
+            rng (numpy.random.Generator): generator of this cycle;
+                                          cycle_rng(seed, date) if None.
+
+        Returns:
+            numpy.random.Generator: generator to be passed to perturb()
+        """
+        if rng is None:
+            rng = cycle_rng(self.seed, date)
+        nvars, eTot, nvec = xa.shape
+        for idx in self.varidx:
+            if self.method == "multiplicative":
+                multiplicative(xa[idx], self.factor)
+            elif self.method == "additive":
+                z = draw_normal(rng, eTot, nvec, self.unit, self.classid)
+                additive(xa[idx], self.factor, z)
+            elif self.method == "rtps":
+                rtps(xa[idx], fspread[idx], self.factor)
+        return rng
+
+    def perturb(self, date, xa, rng=None):
+        """
+        returns parameters with noise.
+
+        Args:
+            date (datetime.datetime): analysis date
+            xa (np.ndarray): analysis [nvars, eTot, nvec]
+            rng (numpy.random.Generator): output of apply();
+                                          cycle_rng(seed, date) if None.
+
+        Returns:
+            np.ndarray: [nvars, eTot, nvec]; equal to xa except noiseidx.
+                        None if there is no noise.
+        """
+        if not self.has_noise:
+            return None
+        if rng is None:
+            rng = cycle_rng(self.seed, date)
+        nvars, eTot, nvec = xa.shape
+        xp = np.array(xa, copy=True)
+        for idx in self.noiseidx:
+            z = draw_normal(rng, eTot, nvec, self.noiseunit, self.classid)
+            xp[idx] = multiply_noise(xa[idx], self.noisestd,
+                                     self.noisebounds[0], self.noisebounds[1],
+                                     z, dist=self.statedist[idx])
+        return xp
@@ -0,0 +1,143 @@
+import os
+import json
+import hashlib
+import numpy as np
+import dautils as dau
+import calc_storage
+
+"""
+cache of vectorized static maps shared by worker processes.
+
+Static CaMa-Flood maps used in post-processing are vectorized once at
+AssimCama.register() and saved as a bundle of .npy files:
+
+    cachedir/manifest.json
+    cachedir/{name}.npy     rivwth, rivlen, rivhgt, grarea [nvec],
+                            fldgrd, wthtab, dphtab [nlfp, nvec],
+                            map2vec [nlat, nlon],
+                            vec2lat, vec2lon, vec2flat [nvec]
+
+Workers open the bundle with np.load(mmap_mode="r"), so the arrays are
+shared through the page cache and read only once per run. The bundle
+is rebuilt when the source maps, the vectorization index or nlfp change.
+"""
+
+# name, file in mapdir, True if the map has nlfp layers
+STATIC_MAPS = [("rivwth", "rivwth_gwdlr.bin", False),
+               ("rivlen", "rivlen.bin", False),
+               ("rivhgt", "rivhgt.bin", False),
+               ("grarea", "ctmare.bin", False),
+               ("fldgrd", "fldgrd.bin", True)]
+TABLES = ["wthtab", "dphtab"]
+INDEX = ["map2vec", "vec2lat", "vec2lon", "vec2flat"]
+
+_loaded = {}
+
+
+def make_manifest(mapdir, nlat, nlon, map2vec, nlfp):
+    """
+    returns dict identifying the source of a bundle.
+    """
+    sources = {}
+    for _, fname, _ in STATIC_MAPS:
+        stat = os.stat(os.path.join(mapdir, fname))
+        sources[fname] = [stat.st_size, stat.st_mtime_ns]
+    index = hashlib.sha1(np.ascontiguousarray(map2vec).tobytes()).hexdigest()
+    return {"mapdir": os.path.abspath(mapdir), "nlat": nlat, "nlon": nlon,
+            "nlfp": nlfp, "index": index, "sources": sources}
+
+
+def vectorize_static(mapdir, nlat, nlon, map2vec, nvec, nlfp,
+                     vec2flat=None):
+    """
+    read and vectorize static maps, and make floodplain tables.
+
+    Args:
+        mapdir (str): map directory
+        nlat (int): number of latitudinal grid cells
+        nlon (int): number of longitudinal grid cells
+        map2vec (np.ndarray): 2d index to vecid
+        nvec (int): length of whole vector
+        nlfp (int): number of flood plain layers
+        vec2flat (np.ndarray): output of dautils.make_flatIndex()
+
+    Returns:
+        dict: rivwth, rivlen, rivhgt, grarea [nvec], fldgrd [nlfp, nvec],
+              wthtab, dphtab [nlfp, nvec]
+    """
+    maps = {}
+    for name, fname, layered in STATIC_MAPS:
+        maps[name] = dau.load_data3d(os.path.join(mapdir, fname),
+                                     nlfp if layered else 1, nlat, nlon,
+                                     map2vec, nvec, dtype=np.float32,
+                                     vec2flat=vec2flat)
+        if not layered:
+            maps[name] = maps[name][0]
+    maps["wthtab"], maps["dphtab"] = \
+        calc_storage.make_fldtable(maps["rivwth"], maps["rivlen"],
+                                   maps["grarea"], maps["fldgrd"],
+                                   nvec, nlfp)
+    return maps
+
+
+def build(cachedir, mapdir, nlat, nlon, map2vec, vec2lat, vec2lon, nlfp):
+    """
+    vectorize static maps and floodplain tables into cachedir
+    together with the vectorization index, unless an up-to-date
+    bundle exists.
+
+    Args:
+        cachedir (str): cache directory
+        mapdir (str): map directory
+        nlat (int): number of latitudinal grid cells
+        nlon (int): number of longitudinal grid cells
+        map2vec (np.ndarray): 2d index to vecid
+        vec2lat (np.ndarray): vecid to latitudinal index
+        vec2lon (np.ndarray): vecid to longitudinal index
+        nlfp (int): number of flood plain layers
+
+    Returns:
+        bool: True if the bundle was (re)built
+    """
+    manifest = make_manifest(mapdir, nlat, nlon, map2vec, nlfp)
+    mpath = os.path.join(cachedir, "manifest.json")
+    if os.path.exists(mpath):
+        with open(mpath, "r") as f:
+            if json.load(f) == manifest:
+                return False
+        # invalidate before overwriting
+        os.remove(mpath)
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    vec2flat = dau.make_flatIndex(vec2lat, vec2lon, nlon)
+    maps = vectorize_static(mapdir, nlat, nlon, map2vec, len(vec2lat), nlfp,
+                            vec2flat=vec2flat)
+    maps.update({"map2vec": map2vec, "vec2lat": vec2lat,
+                 "vec2lon": vec2lon, "vec2flat": vec2flat})
+    for name, data in maps.items():
+        np.save(os.path.join(cachedir, "{0}.npy".format(name)), data)
+    with open(mpath, "w") as f:
+        json.dump(manifest, f)
+    return True
+
+
+def load(cachedir):
+    """
+    open a bundle read-only. memoized per process.
+
+    Args:
+        cachedir (str): cache directory made by build()
+
+    Returns:
+        dict: np.memmap arrays keyed by name
+    """
+    if cachedir in _loaded:
+        return _loaded[cachedir]
+    if not os.path.exists(os.path.join(cachedir, "manifest.json")):
+        raise IOError("{0} is not a complete map cache.".format(cachedir))
+    maps = {}
+    for name in [m[0] for m in STATIC_MAPS] + TABLES + INDEX:
+        maps[name] = np.load(os.path.join(cachedir, "{0}.npy".format(name)),
+                             mmap_mode="r")
+    _loaded[cachedir] = maps
+    return maps
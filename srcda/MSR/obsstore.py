@@ -0,0 +1,189 @@
+import numpy as np
+import pytz
+
+"""
+date-indexed observation store used by AssimCama.const_obs().
+
+Observations are parsed once from the xarray dataset (see
+data/MSR/src/map_widths.ipynb) into a compact CSR-style layout per
+observation variable:
+    indptr [ntime+1], vecid [nobs], value [nobs], error [nobs]
+with the distribution transform (e.g., log) already applied, so that
+the lookup for a date is a dictionary access and a slice. The dataset
+is read in chunks of dates, so peak memory while parsing is bounded by
+the chunk, not by the length of the record.
+"""
+
+
+def to_datetime64(date):
+    """
+    convert datetime.datetime (naive utc or aware) to np.datetime64[ns].
+    """
+    if isinstance(date, np.datetime64):
+        return date.astype("datetime64[ns]")
+    if date.tzinfo is not None:
+        date = date.astimezone(pytz.utc).replace(tzinfo=None)
+    return np.datetime64(date, "ns")
+
+
+class ObservationStore(object):
+    """
+    compact observation store built once at AssimCama.register().
+
+    Args:
+        obsdset (xarray.Dataset): observation dataset; each variable has
+                                  dimensions (kind, time, vecid) and kind
+                                  contains values and errors.
+        obsnames (list): observation variable names
+        obsdist (list): distribution of each observation; "log" or "norm"
+        nvec (int): length of whole vector
+        undef (int): undefined value
+        chunk (int): number of dates read from obsdset at once
+    """
+
+    def __init__(self, obsdset, obsnames, obsdist, nvec, undef, chunk=365):
+        self.obsnames = obsnames
+        self.nvec = nvec
+        self.undef = undef
+        self.chunk = max(1, int(chunk))
+        self.times = obsdset["time"].values.astype("datetime64[ns]")
+        self.date2idx = dict((t, idx) for idx, t in
+                             enumerate(self.times.astype(np.int64).tolist()))
+        self.indptr = []
+        self.vecid = []
+        self.value = []
+        self.error = []
+        for idx, obsname in enumerate(obsnames):
+            indptr, vecid, value, error = self.compress(obsdset[obsname],
+                                                        obsdist[idx])
+            self.indptr.append(indptr)
+            self.vecid.append(vecid)
+            self.value.append(value)
+            self.error.append(error)
+        # dense output buffers reused every cycle
+        self._obs = np.ones([len(obsnames), nvec], np.float64)*undef
+        self._err = np.ones([len(obsnames), nvec], np.float64)*undef
+
+    def compress(self, obsarray, dist):
+        """
+        compress one observation variable into CSR-style arrays.
+
+        Args:
+            obsarray (xarray.DataArray): (kind, time, vecid) array
+            dist (str): "log" or "norm"
+
+        Returns:
+            np.ndarray: indptr [ntime+1]
+            np.ndarray: vecid [nobs]
+            np.ndarray: transformed values [nobs]
+            np.ndarray: transformed errors [nobs]
+
+        Notes:
+            dates are read self.chunk at a time; only the observed
+            entries of each chunk are kept.
+        """
+        if dist not in ["log", "norm"]:
+            raise KeyError("undefined distribution: {0}".format(dist))
+        vecids = obsarray["vecid"].values.astype(np.int64)
+        ntime = obsarray.sizes["time"]
+        counts = np.zeros([ntime], dtype=np.int64)
+        vecid, value, error = [], [], []
+        for sta in range(0, ntime, self.chunk):
+            sub = obsarray.isel(time=slice(sta, sta+self.chunk))
+            values = sub.sel(kind="values")\
+                        .transpose("time", "vecid").values
+            defined = (values != self.undef) & np.isfinite(values)
+            # row-major nonzero, thus grouped by time
+            rows, cols = np.nonzero(defined)
+            del defined
+            v = values[rows, cols].astype(np.float64)
+            del values
+            errors = sub.sel(kind="errors")\
+                        .transpose("time", "vecid").values
+            e = errors[rows, cols].astype(np.float64)
+            del errors
+            if dist == "log":
+                v = np.log(v)
+                e = np.log(e)
+            counts[sta:sta+self.chunk] = np.bincount(
+                                rows, minlength=min(self.chunk, ntime-sta))
+            vecid.append(vecids[cols])
+            value.append(v)
+            error.append(e)
+        indptr = np.zeros([ntime+1], dtype=np.int64)
+        indptr[1::] = np.cumsum(counts)
+        if ntime == 0:
+            return indptr, np.zeros([0], np.int64), np.zeros([0]), \
+                np.zeros([0])
+        return indptr, np.concatenate(vecid), np.concatenate(value), \
+            np.concatenate(error)
+
+    def has_date(self, date):
+        """
+        returns True if observation exists at date.
+        """
+        return int(to_datetime64(date).astype(np.int64)) in self.date2idx
+
+    def get_sparse(self, date, obsidx):
+        """
+        returns observations of obsnames[obsidx] at date.
+
+        Args:
+            date (datetime.datetime or np.datetime64): date
+            obsidx (int): index in obsnames
+
+        Returns:
+            np.ndarray: vecid
+            np.ndarray: transformed values
+            np.ndarray: transformed errors
+        """
+        t = int(to_datetime64(date).astype(np.int64))
+        if t not in self.date2idx:
+            raise KeyError("no observation at {0}".format(date))
+        it = self.date2idx[t]
+        sta = self.indptr[obsidx][it]
+        end = self.indptr[obsidx][it+1]
+        return (self.vecid[obsidx][sta:end], self.value[obsidx][sta:end],
+                self.error[obsidx][sta:end])
+
+    def get(self, date):
+        """
+        returns dense observation arrays at date.
+
+        Args:
+            date (datetime.datetime or np.datetime64): date
+
+        Returns:
+            np.ndarray: values [nobsvars, nvec]; undef if not observed
+            np.ndarray: errors [nobsvars, nvec]; undef if not observed
+
+        Notes:
+            returned arrays are buffers reused in the next call.
+            copy them if you need to keep.
+        """
+        return self.get_window([date])
+
+    def get_window(self, dates):
+        """
+        returns dense observation arrays binned over dates.
+
+        Args:
+            dates (list-like): dates in ascending order
+
+        Returns:
+            np.ndarray: values [nobsvars, nvec]; undef if not observed
+            np.ndarray: errors [nobsvars, nvec]; undef if not observed
+
+        Notes:
+            where a vecid is observed more than once, the latest
+            observation wins. returned arrays are buffers reused in the
+            next call.
+        """
+        self._obs[:] = self.undef
+        self._err[:] = self.undef
+        for date in dates:
+            for idx in range(len(self.obsnames)):
+                vecid, value, error = self.get_sparse(date, idx)
+                self._obs[idx, vecid] = value
+                self._err[idx, vecid] = error
+        return self._obs, self._err
@@ -0,0 +1,119 @@
+import numpy as np
+import h5py
+from obsstore import to_datetime64
+
+"""
+consolidated ensemble output store.
+
+CaMa-Flood outputs of each cycle ([nT, nlat, nlon] binaries per member)
+are vectorized to river cells and appended to one chunked, compressed
+HDF5 file per experiment:
+
+    /time          [ntime] datetime64[ns] as int64, first day of record
+    /{varname}     [eTot, ntime, nvec] float32
+
+so that a time series of a reach is a single slice, e.g.,
+f["outwth"][:, :, vecid].
+"""
+
+
+class OutputStore(object):
+    """
+    appender of vectorized ensemble outputs.
+
+    Args:
+        path (str): path to HDF5 file; appended if exists
+        varnames (list): output variable names (e.g., "outwth")
+        eTot (int): total number of ensemble members
+        nvec (int): length of whole vector
+        dtype (np.dtype): data type of the outputs
+        chunkt (int): chunk length in time
+        chunkv (int): chunk length in vecid
+        compression (str): h5py compression filter
+    """
+
+    def __init__(self, path, varnames, eTot, nvec, dtype=np.float32,
+                 chunkt=64, chunkv=4096, compression="gzip"):
+        self.path = path
+        self.varnames = varnames
+        self.eTot = eTot
+        self.nvec = nvec
+        self.f = h5py.File(path, "a")
+        if "time" not in self.f:
+            self.f.create_dataset("time", shape=(0,), maxshape=(None,),
+                                  dtype=np.int64, chunks=(1024,))
+            self.f["time"].attrs["units"] = "ns since 1970-01-01 (utc)"
+        for varname in varnames:
+            if varname in self.f:
+                if self.f[varname].shape[::2] != (eTot, nvec):
+                    raise ValueError("{0} in {1} has shape {2}, not "
+                                     "(eTot, time, nvec)."
+                                     .format(varname, path,
+                                             self.f[varname].shape))
+                continue
+            self.f.create_dataset(varname, shape=(eTot, 0, nvec),
+                                  maxshape=(eTot, None, nvec), dtype=dtype,
+                                  chunks=(1, chunkt, min(chunkv, nvec)),
+                                  compression=compression, shuffle=True)
+
+    @property
+    def ntime(self):
+        return self.f["time"].shape[0]
+
+    def extend(self, date, nT):
+        """
+        extend time axis by nT daily records starting from date.
+
+        Args:
+            date (datetime.datetime): date of the first record
+            nT (int): number of records
+
+        Returns:
+            int: index of the first new record
+        """
+        t0 = self.ntime
+        times = to_datetime64(date) + \
+            np.arange(nT).astype("timedelta64[D]")
+        self.f["time"].resize((t0+nT,))
+        self.f["time"][t0:t0+nT] = times.astype("datetime64[ns]")\
+                                        .astype(np.int64)
+        for varname in self.varnames:
+            self.f[varname].resize(t0+nT, axis=1)
+        return t0
+
+    def write(self, eNum, t0, data):
+        """
+        write outputs of a member.
+
+        Args:
+            eNum (int): ensemble member id
+            t0 (int): index of the first record (from extend())
+            data (np.ndarray): [nvars, nT, nvec] in order of varnames
+        """
+        nT = data.shape[1]
+        for idx, varname in enumerate(self.varnames):
+            self.f[varname][eNum, t0:t0+nT, :] = data[idx]
+
+    def truncate(self, date):
+        """
+        drop records at or after date (e.g., when restarting from
+        a checkpoint).
+
+        Args:
+            date (datetime.datetime): first date to drop
+        """
+        times = self.f["time"][:]
+        nt = int(np.searchsorted(times, to_datetime64(date).astype(np.int64),
+                                 side="left"))
+        if nt == len(times):
+            return
+        self.f["time"].resize((nt,))
+        for varname in self.varnames:
+            self.f[varname].resize(nt, axis=1)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.f:
+            self.f.close()
@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import contextlib
+from collections import OrderedDict
+
+"""
+per-phase timing of assimilation cycles.
+
+PhaseTimer.phase() records wall time, cpu time (of the process and of
+its waited-for child processes, e.g., CaMa-Flood), bytes read/written
+from storage (/proc/self/io; None where not available) and peak RSS of
+a block of code. Every process keeps its own timer; workers of the
+EnsemblePool return their records through collect(), and the driver
+appends all records of a cycle to one JSON-lines log:
+
+    {"cycle": "2000010100", "phase": "forward", "member": 0,
+     "pid": 1234, "start": 946684800.0, "wall": 12.3, "cpu": 11.9,
+     "childcpu": 230.1, "read": 1048576, "write": 4096,
+     "maxrss": 123456789}
+
+Summary of where each cycle's wall clock went:
+
+    python profiler.py profile.jsonl [--cycle 2000010100]
+"""
+
+
+def read_io():
+    """
+    returns bytes read from and written to storage by this process.
+
+    Returns:
+        tuple: (read_bytes, write_bytes); (None, None) if /proc/self/io
+               is not available.
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            io = dict(line.split(":") for line in f)
+        return int(io["read_bytes"]), int(io["write_bytes"])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+
+def maxrss():
+    """
+    returns peak RSS [bytes] of this process.
+    ru_maxrss is in kilobytes on linux, in bytes on macOS.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss*1024
+
+
+def snapshot():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {"start": time.time(), "wall": time.perf_counter(),
+            "cpu": time.process_time(),
+            "childcpu": children.ru_utime + children.ru_stime,
+            "io": read_io()}
+
+
+class PhaseTimer(object):
+    """
+    recorder of per-phase resource usage.
+
+    Args:
+        path (str): JSON-lines log appended by flush(); None to keep
+                    records in memory only (e.g., in workers).
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.records = []
+        if path is not None and os.path.dirname(path) != "" \
+           and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+    @contextlib.contextmanager
+    def phase(self, name, **tags):
+        """
+        record resource usage of the with-block as a phase.
+
+        Args:
+            name (str): phase name
+            **tags: additional fields of the record, e.g., member=eNum
+        """
+        s = snapshot()
+        try:
+            yield
+        finally:
+            e = snapshot()
+            record = OrderedDict([("phase", name)])
+            record.update(tags)
+            record["pid"] = os.getpid()
+            record["start"] = s["start"]
+            record["wall"] = e["wall"] - s["wall"]
+            record["cpu"] = e["cpu"] - s["cpu"]
+            record["childcpu"] = e["childcpu"] - s["childcpu"]
+            for idx, key in enumerate(["read", "write"]):
+                record[key] = None if s["io"][idx] is None \
+                    else e["io"][idx] - s["io"][idx]
+            record["maxrss"] = maxrss()
+            self.records.append(record)
+
+    def extend(self, records):
+        """
+        add records made in other processes (see collect()).
+        """
+        self.records.extend(records)
+
+    def drain(self):
+        """
+        returns records and clears those.
+        """
+        records = self.records
+        self.records = []
+        return records
+
+    def flush(self, cycle):
+        """
+        append records to the log as phases of a cycle, and clear those.
+
+        Args:
+            cycle (datetime.datetime or str): date of the cycle, or
+                                              a label (e.g., "spinup")
+        """
+        records = self.drain()
+        if self.path is None:
+            return
+        if hasattr(cycle, "strftime"):
+            cycle = cycle.strftime("%Y%m%d%H")
+        with open(self.path, "a") as f:
+            for record in records:
+                line = OrderedDict([("cycle", cycle)])
+                line.update(record)
+                f.write(json.dumps(line) + "\n")
+
+
+# timer of this process; used by module-level functions run in workers.
+timer = PhaseTimer()
+
+
+def phase(name, **tags):
+    """
+    shortcut of timer.phase() of this process.
+    """
+    return timer.phase(name, **tags)
+
+
+def collect(args):
+    """
+    returns records of the worker process and clears those.
+    submitted to every member by EnsemblePool.map(); workers owning
+    several members return their records once.
+
+    Args:
+        args (list): not used
+    """
+    return timer.drain()
+
+
+# summary
+def read_log(path):
+    """
+    returns records in the log grouped by cycle.
+
+    Args:
+        path (str): JSON-lines log
+
+    Returns:
+        OrderedDict: {cycle: [record, ...]} in order of the log
+    """
+    cycles = OrderedDict()
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            record = json.loads(line)
+            cycles.setdefault(record["cycle"], []).append(record)
+    return cycles
+
+
+def summarize(records):
+    """
+    aggregate records of a cycle by phase.
+
+    Args:
+        records (list): records of a cycle
+
+    Returns:
+        list: rows of [phase, count, total wall, max wall, cpu,
+              childcpu, read, write, maxrss] in order of appearance.
+              total is summed over members/workers running
+              concurrently; max is the slowest of those.
+    """
+    rows = OrderedDict()
+    for r in records:
+        if r["phase"] not in rows:
+            rows[r["phase"]] = [r["phase"], 0, 0., 0., 0., 0., 0, 0, 0]
+        row = rows[r["phase"]]
+        row[1] += 1
+        row[2] += r["wall"]
+        row[3] = max(row[3], r["wall"])
+        row[4] += r["cpu"]
+        row[5] += r["childcpu"]
+        row[6] += r["read"] or 0
+        row[7] += r["write"] or 0
+        row[8] = max(row[8], r["maxrss"])
+    return list(rows.values())
+
+
+def print_summary(cycle, records, out=sys.stdout):
+    """
+    print where the wall clock of a cycle went.
+    shares are of the "cycle" phase if recorded, else of the sum
+    of max wall over phases.
+    """
+    rows = summarize(records)
+    total = [row[3] for row in rows if row[0] == "cycle"]
+    total = total[0] if total else sum(row[3] for row in rows)
+    mb = 1024.**2
+    out.write("cycle {0}: {1:.1f} s\n".format(cycle, total))
+    out.write("{0:<20s}{1:>4s}{2:>10s}{3:>10s}{4:>7s}{5:>10s}{6:>10s}"
+              "{7:>10s}{8:>10s}{9:>10s}\n"
+              .format("phase", "n", "wall", "max", "share", "cpu",
+                      "childcpu", "read MB", "write MB", "rss MB"))
+    for row in rows:
+        out.write("{0:<20s}{1:>4d}{2:>10.2f}{3:>10.2f}{4:>7.1%}{5:>10.2f}"
+                  "{6:>10.2f}{7:>10.1f}{8:>10.1f}{9:>10.1f}\n"
+                  .format(row[0], row[1], row[2], row[3],
+                          row[3]/total if total > 0 else 0, row[4],
+                          row[5], row[6]/mb, row[7]/mb, row[8]/mb))
+    out.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                description="summary of a profile log by cycle and phase.")
+    parser.add_argument("path", help="JSON-lines log written by PhaseTimer")
+    parser.add_argument("--cycle", default=None,
+                        help="cycle to show (YYYYMMDDHH); all if omitted")
+    args = parser.parse_args(argv)
+    cycles = read_log(args.path)
+    if args.cycle is not None:
+        if args.cycle not in cycles:
+            raise KeyError("cycle {0} is not in {1}."
+                           .format(args.cycle, args.path))
+        cycles = {args.cycle: cycles[args.cycle]}
+    for cycle, records in cycles.items():
+        print_summary(cycle, records)
+
+
+if __name__ == "__main__":
+    main()
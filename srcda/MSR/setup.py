@@ -7,8 +7,8 @@ extentions = [
     Extension('calc_storage',
               sources=['./cysrc/calc_storage.pyx'],
               include_dirs=[],
-              extra_compile_args=['-O3'],
-              extra_link_args=[])
+              extra_compile_args=['-O3', '-fopenmp'],
+              extra_link_args=['-fopenmp'])
 ]
 
 setup(
@@ -20,8 +20,8 @@ extentions = [
     Extension('camavec',
               sources=['./cysrc/camavec.pyx'],
               include_dirs=[np.get_include()],
-              extra_compile_args=['-O3'],
-              extra_link_args=[])
+              extra_compile_args=['-O3', '-fopenmp'],
+              extra_link_args=['-fopenmp'])
 ]
 
 setup(
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+import os
+import sys
+import datetime
+import numpy as np
+import dautils as dau
+import calc_storage
+import mapcache
+
+"""
+stand-in of CaMa-Flood (MSR_03min_outwth.sh) for local end-to-end runs.
+
+Set "camagosh" in config.json to this file; it is called as
+run_CaMa() calls the gosh file, with vars_XX.txt made by
+caseExtention.make_vars():
+
+    surrogate_cama.py ${RDIR}/vars_XX.txt
+
+and follows the same file contract in RDIR:
+    - reads restart.bin [rivsto, fldsto] if SPINUP=1 (zero storage if
+      it does not exist yet), starts from zero storage and removes old
+      outputs if SPINUP=0
+    - reads parameters from CRIVHGT, CRIVMAN and CRIVSHP
+    - writes outflw.bin, outwth.bin and flddph.bin [nT, nlat, nlon]
+      (one daily record from YSTA/SMON/SDAY until YEND/EMON/EDAY 00:00,
+      1e20 out of rivers) and restart.bin at the end.
+
+The map is ${BASE}/map/MSR_03min (SURROGATE_MAPDIR to override);
+nlon, nlat and nlfp are read from params.txt in the map directory.
+River cells are the vector domain of the DA, read with the static maps
+from the map cache of AssimCama.register() (mapcache.py), by default
+the "mapcache" directory next to RDIR (SURROGATE_MAPCACHE to override);
+thus every cell of the state vector has outputs.
+Routing is a linear reservoir per cell with Manning velocity, solved
+with hourly sub-steps. Storage is converted to flow width and
+floodplain depth by inverting the geometry of calc_storage, so that
+restart.bin written by caseExtention.rewrite_restart() is read back as
+the analysis flow width. Runoff is read from
+${CROFDIR}/Roff_15min_MSR${YYYYMMDD}.bin (SURROGATE_ROFPRE to override)
+if it is on the model grid [mm/day]; otherwise a seasonal runoff of
+SURROGATE_RUNOFF mm/day (default 1) is used. CRIVBTA, bifurcations,
+spinup repeats and OpenMP are ignored.
+"""
+
+SLOPE = 1e-4  # channel slope of Manning velocity
+DT = 3600  # sub-step [s]
+UNDEF = 1e20
+
+
+def read_vars(path):
+    """
+    returns dict of vars_XX.txt (NAME=value per line).
+    """
+    varDict = {}
+    with open(path, "r") as f:
+        for line in f:
+            if "=" not in line:
+                continue
+            name, value = line.strip().split("=", 1)
+            varDict[name] = value
+    return varDict
+
+
+def read_params(mapdir):
+    """
+    returns nlon, nlat, nlfp from params.txt in mapdir.
+    the first token of the first three lines, as in CaMa-Flood.
+    """
+    with open(os.path.join(mapdir, "params.txt"), "r") as f:
+        lines = f.readlines()
+    return tuple(int(lines[idx].split()[0]) for idx in range(3))
+
+
+def get_simrange(varDict):
+    """
+    returns start date and end date (exclusive) of the run.
+    """
+    sdate = datetime.datetime(int(varDict["YSTA"]), int(varDict["SMON"]),
+                              int(varDict["SDAY"]))
+    edate = datetime.datetime(int(varDict["YEND"]), int(varDict["EMON"]),
+                              int(varDict["EDAY"]))
+    return sdate, edate
+
+
+class Geometry(object):
+    """
+    river and floodplain geometry of calc_storage in vector space.
+
+    Args:
+        maps (dict): output of mapcache.vectorize_static()
+        rivhgt (np.ndarray): river height [nvec]
+        rivshp (np.ndarray): river shape parameter [nvec]
+        nlfp (int): number of flood plain layers
+
+    Notes:
+        invert() is the inverse of get_storage_invertsely(): within the
+        bank, width is a power of storage; on the floodplain, depth is
+        linear in width within a layer, thus storage is quadratic in
+        width. The layer is found from storage at layer boundaries.
+    """
+
+    def __init__(self, maps, rivhgt, rivshp, nlfp):
+        self.maps = maps
+        self.nlfp = nlfp
+        self.rivwth = maps["rivwth"].astype(np.float64)
+        self.rivlen = maps["rivlen"].astype(np.float64)
+        self.rivhgt = rivhgt.astype(np.float32)
+        self.rivshp = rivshp.astype(np.float32)
+        s = self.rivshp.astype(np.float64)
+        # bank-full cross section area
+        self.bankfull = self.rivhgt*self.rivwth*s/(s+1)
+        self.wthtab = maps["wthtab"].astype(np.float64)
+        self.dphtab = maps["dphtab"].astype(np.float64)
+        self.fldgrd = maps["fldgrd"].astype(np.float64)
+        # total storage at each layer boundary [nlfp, nvec]
+        self.stotab = np.stack([self.storage(w.astype(np.float32)).sum(0)
+                                for w in maps["wthtab"]])
+
+    def storage(self, outwth):
+        """
+        returns [rivsto, fldsto] [2, nvec] of flow width.
+        """
+        return calc_storage.get_storage_invertsely(
+                outwth.astype(np.float32), self.maps["rivwth"],
+                self.maps["rivlen"], self.rivhgt, self.rivshp,
+                self.maps["grarea"], self.maps["fldgrd"], len(outwth),
+                self.nlfp, -9999, wthtab=self.maps["wthtab"],
+                dphtab=self.maps["dphtab"]).astype(np.float64)
+
+    def invert(self, storage):
+        """
+        returns flow width, floodplain depth and mean river depth
+        of total storage [nvec].
+        """
+        s = self.rivshp.astype(np.float64)
+        rivhgt = self.rivhgt.astype(np.float64)
+        area = storage/self.rivlen
+        inbank = area < self.bankfull
+        ratio = np.clip(area/self.bankfull, 0, 1)
+        outwth = self.rivwth*ratio**(1/(s+1))
+        rivdph = rivhgt*ratio**(s/(s+1))*s/(s+1)
+        flddph = np.zeros_like(storage)
+        if inbank.all():
+            return outwth, flddph, rivdph
+        # outbank; hflp = c0 + g*w in the layer of the storage, and
+        # (w + rivwth)*hflp/2 = area - bankfull (see calc_storage)
+        idx = np.arange(len(storage))
+        k = np.clip((storage[None] > self.stotab).sum(axis=0)-1,
+                    0, self.nlfp-1)
+        anchor = np.minimum(k+1, self.nlfp-1)
+        g = self.fldgrd[np.minimum(k, max(self.nlfp-2, 0)), idx]
+        c0 = self.dphtab[anchor, idx] - g*self.wthtab[anchor, idx]
+        b = c0 + g*self.rivwth
+        c = 2*(area - self.bankfull) - self.rivwth*c0
+        # stable root of g*w**2 + b*w - c = 0
+        wflp = 2*c/(b + np.sqrt(np.maximum(b*b + 4*g*c, 0)))
+        hflp = c0 + g*wflp
+        outbank = ~inbank
+        outwth[outbank] = wflp[outbank]
+        flddph[outbank] = hflp[outbank]
+        rivdph[outbank] = rivhgt[outbank] + hflp[outbank]
+        return outwth, flddph, rivdph
+
+
+def get_runoff(date, crofdir, ctmare, nlat, nlon, map2vec, nvec, vec2flat):
+    """
+    returns runoff of a day [m3/s] in vector space.
+    """
+    rofpre = os.environ.get("SURROGATE_ROFPRE", "Roff_15min_MSR")
+    path = os.path.join(crofdir, "{0}{1}.bin".format(rofpre,
+                                                     date.strftime("%Y%m%d")))
+    if os.path.exists(path) and os.path.getsize(path) == nlat*nlon*4:
+        rof = dau.load_data3d(path, 1, nlat, nlon, map2vec, nvec,
+                              vec2flat=vec2flat)[0].astype(np.float64)
+        rof[rof < 0] = 0
+    else:
+        doy = date.timetuple().tm_yday
+        rof = float(os.environ.get("SURROGATE_RUNOFF", 1)) * \
+            (1 + 0.5*np.sin(2*np.pi*(doy-80)/365.))*np.ones(nvec)
+    return rof/1000.*ctmare/86400.
+
+
+def run(varspath):
+    """
+    run the surrogate model with vars_XX.txt.
+    """
+    varDict = read_vars(varspath)
+    rdir = varDict["RDIR"]
+    mapdir = os.environ.get("SURROGATE_MAPDIR",
+                            os.path.join(varDict["BASE"], "map/MSR_03min"))
+    nlon, nlat, nlfp = read_params(mapdir)
+    sdate, edate = get_simrange(varDict)
+    nT = (edate - sdate).days
+    outvars = ["outflw", "outwth", "flddph"]
+
+    # river cells are the vector domain of the DA
+    cachedir = os.environ.get("SURROGATE_MAPCACHE",
+                              os.path.join(os.path.dirname(rdir), "mapcache"))
+    maps = mapcache.load(cachedir)
+    map2vec = np.asarray(maps["map2vec"])
+    vec2lat = np.asarray(maps["vec2lat"])
+    vec2lon = np.asarray(maps["vec2lon"])
+    vec2flat = np.asarray(maps["vec2flat"])
+    nvec = len(vec2lat)
+    nextxy = np.fromfile(os.path.join(mapdir, "nextxy.bin"),
+                         np.int32).reshape(2, nlat, nlon)
+    vparams = {}
+    for var in ["CRIVHGT", "CRIVMAN", "CRIVSHP"]:
+        param = np.fromfile(varDict[var], np.float32).reshape(1, nlat, nlon)
+        vparams[var] = dau.vectorize_map(param, map2vec, nvec,
+                                         vec2flat=vec2flat)[0]
+        invalid = ~(vparams[var] > 0)
+        if invalid.any() and not invalid.all():
+            # e.g., undef of the map at a cell of the vector domain
+            sys.stderr.write("{0}: {1} cells are not positive; using the "
+                             "median.\n".format(var, invalid.sum()))
+            vparams[var][invalid] = np.median(vparams[var][~invalid])
+    geometry = Geometry(maps, vparams["CRIVHGT"], vparams["CRIVSHP"], nlfp)
+    rivman = vparams["CRIVMAN"].astype(np.float64)
+
+    # downstream vecid; -1 for mouths and cells out of domain
+    nextx = nextxy[0][vec2lat, vec2lon]
+    nexty = nextxy[1][vec2lat, vec2lon]
+    down = np.full(nvec, -1, dtype=np.int64)
+    valid = (nextx > 0) & (nexty > 0)
+    down[valid] = map2vec[nexty[valid]-1, nextx[valid]-1]
+    down[down < 0] = -1
+    tovec = down >= 0
+
+    # initial storage
+    restartpath = os.path.join(rdir, "restart.bin")
+    if int(varDict["SPINUP"]) == 1 and not os.path.exists(restartpath):
+        sys.stderr.write("{0} does not exist; starting from zero storage.\n"
+                         .format(restartpath))
+        storage = np.zeros(nvec)
+    elif int(varDict["SPINUP"]) == 1:
+        restart = dau.load_data3d(restartpath, 2, nlat, nlon, map2vec, nvec,
+                                  vec2flat=vec2flat).astype(np.float64)
+        restart[restart >= UNDEF] = 0
+        storage = restart.sum(axis=0)
+    else:
+        for var in outvars + ["restart"]:
+            path = os.path.join(rdir, "{0}.bin".format(var))
+            if os.path.exists(path):
+                os.remove(path)
+        storage = np.zeros(nvec)
+
+    outputs = dict((var, np.memmap(os.path.join(rdir, "{0}.bin".format(var)),
+                                   dtype=np.float32, mode="w+",
+                                   shape=(nT, nlat, nlon)))
+                   for var in outvars)
+    nsub = 86400//DT
+    for t in range(nT):
+        date = sdate + datetime.timedelta(days=t)
+        runoff = get_runoff(date, varDict["CROFDIR"], maps["grarea"], nlat,
+                            nlon, map2vec, nvec, vec2flat)
+        outflw = np.zeros(nvec)
+        for _ in range(nsub):
+            _, _, rivdph = geometry.invert(storage)
+            velocity = np.maximum(rivdph, 0)**(2/3.)*np.sqrt(SLOPE)/rivman
+            tau = geometry.rivlen/np.maximum(velocity, 1e-3)
+            released = storage*(1-np.exp(-DT/tau))
+            storage = storage - released + runoff*DT
+            storage += np.bincount(down[tovec], weights=released[tovec],
+                                   minlength=nvec)
+            outflw += released/DT/nsub
+        outwth, flddph, _ = geometry.invert(storage)
+        for var, vec in zip(outvars, [outflw, outwth, flddph]):
+            dau.revert_map_into(vec[None].astype(np.float32), vec2flat,
+                                outputs[var][t:t+1], fill=UNDEF)
+    for var in outvars:
+        outputs[var].flush()
+    del outputs
+
+    # storage-only restart at the end
+    outwth, _, _ = geometry.invert(storage)
+    sto = geometry.storage(outwth).astype(np.float32)
+    restart = np.memmap(restartpath, dtype=np.float32, mode="w+",
+                        shape=(2, nlat, nlon))
+    dau.revert_map_into(sto, vec2flat, restart, fill=UNDEF)
+    del restart
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("usage: {0} vars_XX.txt".format(sys.argv[0]))
+    run(sys.argv[1])
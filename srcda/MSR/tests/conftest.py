@@ -0,0 +1,7 @@
+import os
+import sys
+
+# modules of srcda/MSR are flat and imported by name;
+# build the Cython extensions in place first (python setup.py
+# build_ext --inplace), otherwise tests needing those are skipped.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,38 @@
+import os
+import json
+import pytest
+
+pytest.importorskip("calc_storage")
+pytest.importorskip("camavec")
+benchmark = pytest.importorskip("benchmark")
+
+"""
+regression gate of benchmark.py: the DA hot paths on the synthetic msr
+domain against the committed benchmark_baseline.json. Timings are
+machine dependent, so the gate runs only with RUN_BENCHMARK=1; set
+BENCHMARK_TOLERANCE (default 1.25) on slower machines, or re-save
+baselines with python benchmark.py --save.
+"""
+
+TOLERANCE = os.environ.get("BENCHMARK_TOLERANCE", "1.25")
+
+
+@pytest.mark.skipif(os.environ.get("RUN_BENCHMARK", "0") != "1",
+                    reason="wall-clock gate; set RUN_BENCHMARK=1 to run")
+def test_no_regression():
+    assert os.path.exists(benchmark.BASELINE)
+    assert benchmark.main(["--check", "--tolerance", TOLERANCE]) == 0
+
+
+def test_missing_baseline_fails(tmp_path):
+    path = str(tmp_path/"baseline.json")
+    assert benchmark.main(["--check", "--baseline", path,
+                           "--only", "const_obs"]) == 1
+
+
+def test_regression_fails(tmp_path):
+    path = str(tmp_path/"baseline.json")
+    with open(path, "w") as f:
+        json.dump({"msr_e4_t10": {"results": {"const_obs": 1e-9}}}, f)
+    assert benchmark.main(["--check", "--baseline", path, "--retries", "0",
+                           "--only", "const_obs"]) == 1
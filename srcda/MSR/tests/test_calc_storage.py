@@ -0,0 +1,120 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+
+calc_storage = pytest.importorskip("calc_storage")
+pyximport = pytest.importorskip("pyximport")
+pyximport.install(language_level=3,
+                  build_dir=os.path.join(tempfile.gettempdir(), "pyxbld"))
+import old_calc_storage  # noqa: E402
+
+# serial layer walk of the baseline
+old_walk = old_calc_storage.get_storage_invertsely
+
+"""
+get_storage_invertsely() (binary search over make_fldtable()) against
+get_storage_reference() and a frozen copy of the serial layer walk of
+the baseline (old_calc_storage.pyx, compiled with pyximport), in single
+and double precision.
+"""
+
+NLFP = 10
+UNDEF = -9999
+
+
+def make_cells(dtype, nvec=400, seed=0):
+    """
+    returns arguments of get_storage_invertsely() with in-channel,
+    floodplain and beyond-the-last-layer flow widths, and undef rivhgt.
+    """
+    rng = np.random.default_rng(seed)
+    rivwth = rng.uniform(20, 400, nvec)
+    rivlen = rng.uniform(1000, 5000, nvec)
+    grarea = rng.uniform(1e6, 1e8, nvec)
+    wthinc = grarea/(rivlen*NLFP)
+    kind = np.arange(nvec) % 4
+    outwth = np.where(kind == 0, rivwth*rng.uniform(0.01, 0.99, nvec),
+                      rivwth + wthinc*rng.uniform(0.01, NLFP-1, nvec))
+    # beyond the last layer boundary
+    outwth[kind == 2] = rivwth[kind == 2] + wthinc[kind == 2]*NLFP*2
+    rivhgt = rng.uniform(1, 10, nvec)
+    rivhgt[kind == 3] = UNDEF
+    cast = [np.asarray(a, dtype=dtype) for a in
+            [outwth, rivwth, rivlen, rivhgt, rng.uniform(1, 5, nvec), grarea]]
+    fldgrd = rng.uniform(0.001, 0.05, (NLFP, nvec)).astype(dtype)
+    return cast + [fldgrd, nvec, NLFP, UNDEF]
+
+
+@pytest.fixture(params=[np.float32, np.float64], ids=["float32", "float64"])
+def cells(request):
+    return make_cells(request.param)
+
+
+def test_identical_to_reference(cells):
+    fast = calc_storage.get_storage_invertsely(*cells)
+    ref = calc_storage.get_storage_reference(*cells)
+    assert fast.dtype == cells[0].dtype
+    np.testing.assert_array_equal(fast, ref)
+
+
+def test_identical_with_cached_tables(cells):
+    wthtab, dphtab = calc_storage.make_fldtable(cells[1], cells[2],
+                                                cells[5], cells[6],
+                                                cells[7], cells[8])
+    fast = calc_storage.get_storage_invertsely(*cells, wthtab=wthtab,
+                                               dphtab=dphtab)
+    np.testing.assert_array_equal(fast,
+                                  calc_storage.get_storage_invertsely(*cells))
+
+
+def test_identical_to_old_walk(cells):
+    fast = calc_storage.get_storage_invertsely(*cells)
+    old = old_walk(*cells)
+    np.testing.assert_array_equal(fast, old)
+
+
+def test_inchannel(cells):
+    outwth, rivwth = cells[0], cells[1]
+    inbank = (outwth < rivwth) & (cells[3] != UNDEF)
+    assert inbank.any()
+    fast = calc_storage.get_storage_invertsely(*cells)
+    assert (fast[0, inbank] > 0).all()
+    np.testing.assert_array_equal(fast[1, inbank], 0)
+
+
+def test_undef_rivhgt(cells):
+    undef = cells[3] == UNDEF
+    assert undef.any()
+    fast = calc_storage.get_storage_invertsely(*cells)
+    np.testing.assert_array_equal(fast[:, undef], 0)
+
+
+def test_bankfull(cells):
+    """
+    outwth == rivwth: no floodplain storage and bank-full river storage.
+    the baseline read fldgrd[-1] out of bounds here.
+    """
+    cells = list(cells)
+    outwth = cells[0].copy()
+    outwth[::5] = cells[1][::5]
+    cells[0] = outwth
+    bankfull = np.zeros(len(outwth), dtype=bool)
+    bankfull[::5] = True
+    bankfull &= cells[3] != UNDEF
+    fast = calc_storage.get_storage_invertsely(*cells)
+    ref = calc_storage.get_storage_reference(*cells)
+    np.testing.assert_array_equal(fast, ref)
+    np.testing.assert_array_equal(fast[1, bankfull], 0)
+    rivwth, rivlen, rivhgt, rivshp = cells[1:5]
+    s1 = rivshp[bankfull] + 1
+    expected = rivlen[bankfull]*(rivwth[bankfull]*rivhgt[bankfull] *
+                                 (1-(1/s1)))
+    np.testing.assert_allclose(fast[0, bankfull], expected, rtol=1e-6)
+    with pytest.raises(IndexError):
+        old_walk(*cells)
+    # elsewhere identical to the baseline
+    others = list(cells)
+    others[3] = np.where(bankfull, UNDEF, cells[3]).astype(cells[3].dtype)
+    np.testing.assert_array_equal(
+        calc_storage.get_storage_invertsely(*others), old_walk(*others))
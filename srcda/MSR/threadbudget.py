@@ -0,0 +1,148 @@
+import os
+import math
+import camavec
+
+"""
+splits the cores of a node between concurrently running ensemble
+members and OpenMP threads of each member.
+
+CaMa-Flood is OpenMP parallel. Running nprocs members at once with
+OMP_NUM_THREADS threads each must satisfy nprocs*nthreads <= ncores,
+otherwise the node is oversubscribed. Each concurrent slot (a worker
+of enspool.EnsemblePool) is pinned to its own set of cores, and the
+CaMa-Flood process launched from the worker inherits the set, and
+OpenMP loops of the worker itself (camavec, calc_storage) use nthreads.
+"""
+
+
+def available_cores():
+    """
+    returns cores available to this process.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def limit_threads(nthreads):
+    """
+    limit OpenMP threads of this process, and of processes launched
+    from it, to nthreads.
+
+    Args:
+        nthreads (int): number of threads
+    """
+    os.environ["OMP_NUM_THREADS"] = str(nthreads)
+    # the runtime reads OMP_NUM_THREADS only once; set it directly too.
+    camavec.set_num_threads(int(nthreads))
+
+
+def candidate_splits(ncores, eTot, maxprocs):
+    """
+    returns all (nprocs, nthreads) splits that use the cores
+    without oversubscription, with as many threads as possible
+    for each nprocs.
+
+    Args:
+        ncores (int): number of cores
+        eTot (int): total number of ensemble members
+        maxprocs (int): upper limit of concurrent members
+
+    Returns:
+        list: (nprocs, nthreads) tuples, descending order of nprocs
+    """
+    splits = []
+    for nthreads in range(1, ncores+1):
+        nprocs = min(ncores//nthreads, eTot, maxprocs)
+        if nprocs < 1:
+            continue
+        nthreads = ncores//nprocs
+        if (nprocs, nthreads) not in splits:
+            splits.append((nprocs, nthreads))
+    return splits
+
+
+class ThreadBudget(object):
+    """
+    core budget shared by concurrent members and OpenMP threads.
+
+    Args:
+        cores (list): core ids usable for the experiment
+        eTot (int): total number of ensemble members
+        maxprocs (int): upper limit of concurrent members (nCPUs)
+        nthreads (int): OpenMP threads per member.
+                        None to use len(cores)//maxprocs.
+        autotune (bool): True to try every candidate split once
+                         and keep the fastest afterwards.
+
+    Notes:
+        the cost of a split is estimated from per-member wall times
+        as ceil(eTot/nprocs)*mean(walltime)/nT, i.e., wall time per
+        simulated day of a whole ensemble forwarding.
+    """
+
+    def __init__(self, cores, eTot, maxprocs, nthreads=None,
+                 autotune=False):
+        self.cores = list(cores)
+        self.ncores = len(self.cores)
+        self.eTot = int(eTot)
+        maxprocs = max(1, min(int(maxprocs), self.eTot, self.ncores))
+        if nthreads is None:
+            nthreads = max(1, self.ncores//maxprocs)
+        self.nthreads = int(nthreads)
+        self.nprocs = max(1, min(maxprocs, self.ncores//self.nthreads))
+        self.autotune = autotune
+        self.splits = candidate_splits(self.ncores, self.eTot, maxprocs)
+        self.costs = {}
+
+    def split(self):
+        """
+        returns current (nprocs, nthreads).
+        """
+        return self.nprocs, self.nthreads
+
+    def poolsize(self):
+        """
+        returns the number of worker processes needed for every
+        split that may be used, so that workers are forked only once.
+        """
+        if not self.autotune:
+            return self.nprocs
+        return max([self.nprocs] + [s[0] for s in self.splits])
+
+    def cpusets(self):
+        """
+        returns core sets for each concurrent slot.
+
+        Returns:
+            list: nprocs lists of nthreads core ids
+        """
+        return [self.cores[w*self.nthreads:(w+1)*self.nthreads]
+                for w in range(self.nprocs)]
+
+    def record(self, nT, walltimes):
+        """
+        record per-member wall times of one forwarding with the
+        current split and move to the next split if autotune is True.
+
+        Args:
+            nT (int): number of simulated days
+            walltimes (list): wall time [s] of each member
+
+        Returns:
+            bool: True if the split has changed
+        """
+        if not self.autotune or nT < 1 or len(walltimes) == 0:
+            return False
+        rounds = math.ceil(self.eTot/float(self.nprocs))
+        cost = rounds*(sum(walltimes)/float(len(walltimes)))/nT
+        current = self.split()
+        # the latest measurement replaces the older one
+        self.costs[current] = cost
+        untried = [s for s in self.splits if s not in self.costs]
+        if len(untried) > 0:
+            nextsplit = untried[0]
+        else:
+            nextsplit = min(self.costs, key=self.costs.get)
+        self.nprocs, self.nthreads = nextsplit
+        return nextsplit != current